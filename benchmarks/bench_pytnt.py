@@ -0,0 +1,190 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Benchmarks for the pytnt project
+
+These use synthetic files, so they can be run without the test data.
+They need the pytest-benchmark plugin:
+
+    pytest benchmarks/bench_pytnt.py
+"""
+
+import io
+import os
+import random
+
+import numpy as np
+import pytest
+
+from pytnt import analysis
+from pytnt.find_TNMR_backup_files import find_TNMR_backup_files
+from pytnt.processTNT import TNTfile, cache_clear
+from pytnt.synthetic import make_tnt_file
+from pytnt.utils import SI_PREFIX, convert_si, save_gnuplot_matrix, scan_delay_tables
+
+pytest.importorskip('pytest_benchmark')
+
+DELAY_TABLES = {'de%d:%d' % (i, i % 10): [0.001 * j for j in range(1, 101)]
+                for i in range(1, 21)}
+
+
+@pytest.fixture(scope='module')
+def tntfiles(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('tnt')
+    shapes = {'1d': (16384, 1, 1, 1),
+              '2d': (4096, 256, 1, 1),
+              'large': (4096, 2048, 1, 1)}
+    paths = {}
+    for name, shape in shapes.items():
+        paths[name] = str(tmpdir / (name + '.tnt'))
+        make_tnt_file(paths[name], actual_npts=shape,
+                      delay_tables=DELAY_TABLES, pseq_size=1 << 20)
+    return paths
+
+
+@pytest.fixture(scope='module')
+def backup_dir(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('backups')
+    for i in range(20):
+        subdir = tmpdir / ('sample%d' % i)
+        subdir.mkdir()
+        for j in range(50):
+            (subdir / ('expt%d.tnt' % j)).write_bytes(b'x' * 100)
+            for k in range(5):
+                backup = subdir / ('expt%d_%d.tnt' % (j, k))
+                backup.write_bytes(b'x' * 10)
+                os.utime(str(backup), (0, 0))  # older than the base file
+    return str(tmpdir)
+
+
+def test_open(benchmark, tntfiles):
+    benchmark(TNTfile, tntfiles['2d'])
+
+
+def test_open_lazy(benchmark, tntfiles):
+    benchmark(TNTfile, tntfiles['2d'], lazy=True)
+
+
+def test_delay_scan(benchmark, tntfiles):
+    tnt = TNTfile(tntfiles['2d'], lazy=True)
+    offset = tnt.tnt_sections['PSEQ']['offset']
+
+    def scan():
+        with open(tntfiles['2d'], 'rb') as tntfile:
+            return scan_delay_tables(tntfile, offset)
+    DELAY = benchmark(scan)
+    assert len(DELAY) == len(DELAY_TABLES)
+
+
+@pytest.mark.parametrize('name', ['1d', '2d'])
+def test_LBfft(benchmark, tntfiles, name):
+    tnt = TNTfile(tntfiles[name])
+    benchmark(tnt.LBfft, 10, 1, phase=0.5, ph1=0.1)
+
+
+@pytest.mark.parametrize('ph1', [0, None])
+def test_LBfft_autophase_spectrum(benchmark, tntfiles, ph1):
+    tnt = TNTfile(tntfiles['2d'])
+    benchmark(tnt.LBfft, 10, 1, ph1=ph1, autophase='spectrum')
+
+
+@pytest.mark.parametrize('method', ['LBfft', 'LBzoom'])
+def test_narrow_range(benchmark, tntfiles, method):
+    tnt = TNTfile(tntfiles['2d'])
+    if method == 'LBfft':
+        def spectrum():
+            spectra = tnt.LBfft(10, 4, phase=0.5)
+            (i_max, i_min) = tnt.ppm_points(5, -5, spectra)
+            return spectra[i_max:i_min]
+    else:
+        def spectrum():
+            return tnt.LBzoom(5, -5, None, 10, 4, phase=0.5)[0]
+    benchmark(spectrum)
+
+
+REGIONS = [(40, 30), (10, 0), (-5, -15), (-100, -120)]
+
+
+@pytest.mark.parametrize('method', ['vectorised', 'loop'])
+def test_integrate_regions(benchmark, tntfiles, method):
+    tnt = TNTfile(tntfiles['2d'])
+    spectra = tnt.LBfft(10, 1, phase=0.5)
+    ppm = tnt.freq_ppm(spectra)
+    if method == 'vectorised':
+        integrals = benchmark(analysis.analyse_regions, spectra, ppm, REGIONS).integrals
+    else:
+        def integrate():
+            return np.array([[np.sum(spectra[slice(*tnt.ppm_points(max_ppm, min_ppm, spectra)), i])
+                              for i in range(spectra.shape[1])]
+                             for max_ppm, min_ppm in REGIONS])
+        integrals = benchmark(integrate)
+    assert integrals.shape == (len(REGIONS), 256)
+
+
+def test_LBfft_uncached(benchmark, tntfiles):
+    tnt = TNTfile(tntfiles['2d'])
+
+    def LBfft():
+        cache_clear()
+        return tnt.LBfft(10, 1, phase=0.5, ph1=0.1)
+    benchmark(LBfft)
+
+
+def test_LBfft_large_chunked(benchmark, tntfiles):
+    tnt = TNTfile(tntfiles['large'])
+    benchmark.pedantic(tnt.LBfft, args=(10, 0), rounds=3,
+                       kwargs={'max_memory': 1 << 27})
+
+
+def _convert_si_loop(si_num_list):
+    """The original implementation of convert_si, for comparison"""
+    for index, item in enumerate(si_num_list):
+        try:
+            si_num_list[index] = float(item)
+        except ValueError:
+            if item[-1] in SI_PREFIX:
+                si_num_list[index] = SI_PREFIX[item[-1]] * float(item[:-1])
+            else:
+                raise ValueError("Couldn't convert delay table entires to float!")
+    return np.array(si_num_list)
+
+
+@pytest.fixture(scope='module')
+def delay_tokens():
+    rng = random.Random(0)
+    suffixes = ['', 's', 'm', 'u', 'n']
+    return ['%g%s' % (rng.uniform(0, 1000), rng.choice(suffixes))
+            for _ in range(10000)]
+
+
+@pytest.mark.parametrize('implementation', ['vectorised', 'loop'])
+def test_convert_si(benchmark, delay_tokens, implementation):
+    if implementation == 'vectorised':
+        values = benchmark(convert_si, delay_tokens)
+    else:
+        values = benchmark(lambda: _convert_si_loop(list(delay_tokens)))
+    assert np.array_equal(values, _convert_si_loop(list(delay_tokens)))
+
+
+def test_ppm_points(benchmark, tntfiles):
+    tnt = TNTfile(tntfiles['1d'])
+    benchmark(tnt.ppm_points, 10, -10)
+
+
+def test_save_gnuplot_matrix(benchmark, tntfiles, tmp_path):
+    tnt = TNTfile(tntfiles['2d'])
+    spectra = tnt.LBfft(10, 1)
+    benchmark(save_gnuplot_matrix, tnt, str(tmp_path / 'matrix.dat'),
+              altDATA=spectra)
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_find_backup_files(benchmark, backup_dir, threads):
+    found = []
+
+    def find():
+        del found[:]
+        find_TNMR_backup_files(backup_dir, [lambda d, f: found.append(f)],
+                               io.StringIO(), threads=threads)
+    benchmark(find)
+    assert len(found) == 20 * 50 * 5
@@ -4,3 +4,4 @@
 
 from .processTNT import TNTfile
 from .utils import unsqueeze, save_gnuplot_matrix, dump_params_txt
+from .batch import load_many, iter_files, TNTCollection
@@ -0,0 +1,183 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Integrate regions of many spectra and find the peaks in them
+
+The regions are given as (max_ppm, min_ppm) pairs, and each one covers the
+same points as TNTfile.ppm_points. The spectra can be an array with
+frequency along axis 0, such as the output of TNTfile.LBfft, or the
+(index, block) tuples from TNTfile.iter_LBfft, so that the full set of
+spectra never has to be in memory at once. Either way, the cost is about
+one pass over the points in the regions:
+
+    >>> blocks = tnt.iter_LBfft(10, 1, max_memory=1 << 28)
+    >>> results = analyse_regions(blocks, tnt.axes[0].zero_filled(1),
+    ...                           [(5, 3), (1.5, 0.5)])
+    >>> results.integrals.shape
+    (2, 1000)
+
+The spectra are flattened in Fortran order, as with TNTfile.spec_times, so
+the results have shape (number of regions, number of spectra).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from .axes import Axis
+
+
+RegionResults = namedtuple('RegionResults', ['integrals', 'heights', 'positions'])
+
+
+def _region_indices(ppm, regions):
+    """The start and stop indices of each region in the ppm axis"""
+    regions = np.asarray(regions, dtype=float)
+    # reshape can't infer the number of regions when there are none
+    regions = regions.reshape((-1, 2) if regions.size else (0, 2))
+    if isinstance(ppm, Axis):
+        starts, stops = ppm.ppm_points(regions[:, 0], regions[:, 1])
+    else:
+        # N.B. the ppm array goes from high to low
+        npts = len(ppm)
+        starts = npts - np.searchsorted(ppm[::-1], regions[:, 0], side='right')
+        stops = npts - np.searchsorted(ppm[::-1], regions[:, 1], side='left')
+    return starts, np.maximum(stops, starts)
+
+
+def _ppm_array(ppm):
+    return ppm.freq_ppm if isinstance(ppm, Axis) else np.asarray(ppm)
+
+
+def _integrate(spectra, starts, stops):
+    """Sum the points from start to stop of each region with cumulative sums"""
+    dtype = np.result_type(spectra.dtype, np.float64)
+    integrals = np.zeros((len(starts), spectra.shape[1]), dtype=dtype)
+    if len(starts) == 0 or stops.max() <= starts.min():
+        return integrals
+    # Only the part of the spectra covered by the regions has to be summed
+    first, last = starts.min(), stops.max()
+    cumulative = np.zeros((last - first + 1, spectra.shape[1]), dtype=dtype)
+    np.cumsum(spectra[first:last], axis=0, dtype=dtype, out=cumulative[1:])
+    np.subtract(cumulative[stops - first], cumulative[starts - first], out=integrals)
+    return integrals
+
+
+def _peaks(spectra, ppm, starts, stops):
+    """Find the maximum of the real part of each region with parabolic
+    interpolation between the highest point and its neighbours"""
+    real = np.real(spectra)
+    npts, ncols = real.shape
+    heights = np.full((len(starts), ncols), np.nan)
+    positions = np.full((len(starts), ncols), np.nan)
+    columns = np.arange(ncols)
+    for region, (start, stop) in enumerate(zip(starts, stops)):
+        if stop <= start:
+            continue
+        peak = start + np.argmax(real[start:stop], axis=0)
+        # The neighbours can be outside the region, but not the spectrum
+        centre = np.clip(peak, 1, npts - 2) if npts >= 3 else peak
+        y0 = real[np.maximum(centre - 1, 0), columns]
+        y1 = real[peak, columns]
+        y2 = real[np.minimum(centre + 1, npts - 1), columns]
+        curvature = y0 - 2 * y1 + y2
+        # Only interpolate at local maxima, not where the highest point is
+        # at the edge of a region because the spectrum rises beyond it
+        interior = (centre == peak) & (y1 >= y0) & (y1 >= y2) & (curvature < 0)
+        shift = np.where(interior, 0.5 * (y0 - y2) / np.where(interior, curvature, -1), 0)
+        heights[region] = y1 - 0.25 * (y0 - y2) * shift
+        # The ppm axis is uniform, so interpolate it linearly
+        step = (ppm[np.minimum(centre + 1, npts - 1)] - ppm[np.maximum(centre - 1, 0)]) / 2
+        positions[region] = ppm[peak] + shift * step
+    return heights, positions
+
+
+def _blocks(spectra):
+    """Convert an array of spectra to a single (index, block) tuple"""
+    if isinstance(spectra, np.ndarray):
+        return [((slice(None),) * spectra.ndim, spectra)]
+    return spectra
+
+
+def _map_blocks(function, spectra):
+    """Apply function to each block of spectra and put the results together
+
+    function is called with a 2-D array of the spectra in the block, and
+    returns a tuple of arrays of shape (number of regions, number of spectra
+    in the block)."""
+    pieces = []
+    for index, block in _blocks(spectra):
+        flat = np.reshape(block, (block.shape[0], int(np.prod(block.shape[1:]))), order='F')
+        pieces.append((index, block.shape, function(flat)))
+    if not pieces:
+        raise ValueError("No spectra to analyse")
+
+    # The slices don't always say where the blocks end, but their shapes do
+    ndim = len(pieces[0][1])
+    shape = tuple(max((index[d].start or 0) + block_shape[d]
+                      for index, block_shape, _ in pieces)
+                  for d in range(1, ndim))
+    outputs = [np.empty((result.shape[0],) + shape, dtype=result.dtype, order='F')
+               for result in pieces[0][2]]
+    for index, block_shape, results in pieces:
+        for output, result in zip(outputs, results):
+            output[(slice(None),) + tuple(index[1:])] = np.reshape(
+                result, (result.shape[0],) + block_shape[1:], order='F')
+    nspec = int(np.prod(shape))
+    return tuple(np.reshape(output, (output.shape[0], nspec), order='F')
+                 for output in outputs)
+
+
+def analyse_regions(spectra, ppm, regions):
+    """Integrate each region of each spectrum and find the highest peak in it
+
+    Args:
+        spectra: An array of spectra with frequency along axis 0, or an
+            iterable of (index, block) tuples from TNTfile.iter_LBfft
+        ppm: The frequency axis of the spectra, either as an array, e.g.
+            tnt.freq_ppm(spectra), or as an Axis, e.g. tnt.axes[0].zero_filled(zf)
+        regions: A sequence of (max_ppm, min_ppm) pairs
+
+    Returns:
+        A RegionResults tuple of arrays of shape (number of regions, number
+        of spectra): the integrals (the sums of the points in each region,
+        as in np.sum(spectrum[i_max:i_min])), and the heights and positions
+        (in ppm) of the maxima of the real part. The maxima are
+        interpolated with a parabola through the highest point and its
+        neighbours. For empty regions the heights and positions are nan.
+    """
+    starts, stops = _region_indices(ppm, regions)
+    ppm = _ppm_array(ppm)
+
+    def analyse(block):
+        return (_integrate(block, starts, stops),) + _peaks(block, ppm, starts, stops)
+    return RegionResults(*_map_blocks(analyse, spectra))
+
+
+def integrate_regions(spectra, ppm, regions):
+    """Integrate each region of each spectrum
+
+    The arguments are the same as for analyse_regions.
+
+    Returns:
+        An array of shape (number of regions, number of spectra)
+    """
+    starts, stops = _region_indices(ppm, regions)
+    (integrals,) = _map_blocks(lambda block: (_integrate(block, starts, stops),),
+                               spectra)
+    return integrals
+
+
+def peak_maxima(spectra, ppm, regions):
+    """Find the highest peak in each region of each spectrum
+
+    The arguments are the same as for analyse_regions.
+
+    Returns:
+        Tuple of arrays (heights, positions) of shape (number of regions,
+        number of spectra)
+    """
+    starts, stops = _region_indices(ppm, regions)
+    ppm = _ppm_array(ppm)
+    return _map_blocks(lambda block: _peaks(block, ppm, starts, stops), spectra)
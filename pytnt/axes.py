@@ -0,0 +1,213 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""The time and frequency axes of each dimension of a .tnt file
+
+The points of each axis are evenly spaced, so a time or frequency can be
+converted to the index of a point with a little arithmetic, instead of a
+search through the coordinate array. The indices are the same as the
+corresponding np.searchsorted calls would give.
+"""
+
+from functools import lru_cache
+import math
+from numbers import Number
+
+import numpy as np
+from numpy.fft import fftfreq, fftshift
+
+from .utils import CACHE_SIZE, _readonly
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _freq_Hz(npts, dw, ref_freq):
+    return _readonly(-(fftshift(fftfreq(npts, dw)) + ref_freq))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _freq_ppm(npts, dw, ref_freq, NMR_freq):
+    return _readonly(_freq_Hz(npts, dw, ref_freq) / NMR_freq)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _fid_times(npts, dw):
+    return _readonly(np.arange(npts) * dw)
+
+
+def _any_nan(value):
+    if isinstance(value, Number):
+        return value != value
+    return bool(np.isnan(value).any())
+
+
+def _first_index(position, npts, satisfied):
+    """Find the first index in range(npts) where satisfied(index) is True
+
+    satisfied must be False and then True along the axis, and position (a
+    scalar or array) must be within a point of the answer, or off the end
+    of the axis. Returns npts if satisfied is never True."""
+    if isinstance(position, Number):  # Plain Python is much faster for scalars
+        index = math.ceil(min(max(float(position), -1.0), npts + 1.0))
+        index = min(max(index, 0), npts)
+        # Correct for rounding in the position
+        while index > 0 and satisfied(index - 1):
+            index -= 1
+        while index < npts and not satisfied(index):
+            index += 1
+        return index
+
+    index = np.clip(np.ceil(position), 0, npts).astype(np.intp)
+    if npts == 0:
+        return index
+    for _ in range(2):
+        index = index - ((index > 0) & satisfied(np.maximum(index - 1, 0)))
+        index = index + ((index < npts) & ~satisfied(np.minimum(index, npts - 1)))
+    return index
+
+
+class Axis:
+
+    """The coordinates of the points along one dimension
+
+    The time axis has npts points, spaced by dwell. The frequency axes are
+    those of an npts point spectrum; use zero_filled or with_npts for the
+    axes of a zero-filled spectrum. The coordinate arrays are calculated
+    once and are read-only.
+    """
+
+    def __init__(self, npts, dwell, ob_freq, ref_freq=0.0, sw=None):
+        """
+        Args:
+            npts: Number of points
+            dwell: Time between the points (in s)
+            ob_freq: Observe frequency (in MHz), the frequency of 0 ppm
+                before the reference offset is applied
+            ref_freq: Reference frequency offset (in Hz)
+            sw: Spectral width (in Hz), by default 1 / dwell
+        """
+        self.npts = int(npts)
+        self.dwell = float(dwell)
+        self.ob_freq = float(ob_freq)
+        self.ref_freq = float(ref_freq)
+        self.sw = 1 / self.dwell if sw is None else float(sw)
+        self._resized = {}
+
+    def __repr__(self):
+        return 'Axis(%d, %r, %r, %r)' % (self.npts, self.dwell,
+                                         self.ob_freq, self.ref_freq)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_resized'] = {}
+        return state
+
+    def with_npts(self, npts):
+        """Return the axis of an array with npts points along this dimension,
+        e.g. a zero-filled spectrum"""
+        npts = int(npts)
+        if npts == self.npts:
+            return self
+        if npts not in self._resized:
+            self._resized[npts] = Axis(npts, self.dwell, self.ob_freq,
+                                       self.ref_freq, self.sw)
+        return self._resized[npts]
+
+    def zero_filled(self, zf):
+        """Return the axis of the spectrum from LBfft with zero filling zf"""
+        return self.with_npts(self.npts * 2 ** zf)
+
+    @property
+    def times(self):
+        """The times of the points (in s)"""
+        return _fid_times(self.npts, self.dwell)
+
+    @property
+    def freq_Hz(self):
+        """The frequencies of the points of the spectrum (in Hz)"""
+        return _freq_Hz(self.npts, self.dwell, self.ref_freq)
+
+    @property
+    def freq_ppm(self):
+        """The frequencies of the points of the spectrum (in ppm)"""
+        return _freq_ppm(self.npts, self.dwell, self.ref_freq, self.ob_freq)
+
+    def _ppm_at(self, index):
+        # The same arithmetic as fftfreq, so the results are identical
+        freq_Hz = -((index - self.npts // 2) * (1.0 / (self.npts * self.dwell))
+                    + self.ref_freq)
+        return freq_Hz / self.ob_freq
+
+    def _ppm_index(self, ppm, position, strict):
+        """The first index where freq_ppm is below ppm (strict) or not above
+        it, for a scalar ppm, with position as the first guess"""
+        npts = self.npts
+        index = math.ceil(min(max(position, -1.0), npts + 1.0))
+        index = min(max(index, 0), npts)
+        # Correct for rounding in the position, with the same arithmetic as
+        # _ppm_at inlined, as this is used in tight loops
+        centre = npts // 2
+        step = 1.0 / (npts * self.dwell)
+        ref_freq = self.ref_freq
+        ob_freq = self.ob_freq
+        while index > 0:
+            value = -((index - 1 - centre) * step + ref_freq) / ob_freq
+            if not (value < ppm or (value == ppm and not strict)):
+                break
+            index -= 1
+        while index < npts:
+            value = -((index - centre) * step + ref_freq) / ob_freq
+            if value < ppm or (value == ppm and not strict):
+                break
+            index += 1
+        return index
+
+    def ppm_at(self, index):
+        """The frequencies (in ppm) of the points at index, which is the
+        same as freq_ppm[index] without building the whole array"""
+        return self._ppm_at(np.asarray(index))
+
+    def time_index(self, time, side='left'):
+        """The index of time in the time axis, like np.searchsorted(times, time, side)"""
+        dwell = self.dwell
+        if not isinstance(time, Number):
+            time = np.asarray(time, dtype=float)
+        if _any_nan(time):  # NaN has no position, but searchsorted puts it last
+            return np.searchsorted(self.times, time, side)
+        if side == 'left':
+            return _first_index(time / dwell, self.npts,
+                                lambda index: index * dwell >= time)
+        elif side == 'right':
+            return _first_index(time / dwell, self.npts,
+                                lambda index: index * dwell > time)
+        raise ValueError("side must be 'left' or 'right', not %r" % (side,))
+
+    def ppm_points(self, max_ppm, min_ppm):
+        """Given a maximum and minimum frequency (in ppm), return the indices
+        of the points in the spectrum that correspond to the beginning and
+        one-past-the-end of that range.
+
+        The result is the same as searching the (descending) freq_ppm
+        array, but it doesn't need to be calculated."""
+        scalars = isinstance(max_ppm, Number) and isinstance(min_ppm, Number)
+        if not scalars:
+            max_ppm = np.asarray(max_ppm, dtype=float)
+            min_ppm = np.asarray(min_ppm, dtype=float)
+        if (not (self.ob_freq > 0 and self.dwell > 0)  # Not descending
+                or _any_nan(max_ppm) or _any_nan(min_ppm)):
+            ppm = self.freq_ppm[::-1]
+            return (self.npts - np.searchsorted(ppm, max_ppm, side='right'),
+                    self.npts - np.searchsorted(ppm, min_ppm, side='left'))
+
+        # The (fractional) index of a frequency in the spectrum
+        scale = self.ob_freq * self.npts * self.dwell
+        offset = self.npts // 2 - self.ref_freq * self.npts * self.dwell
+        if scalars:
+            return (self._ppm_index(max_ppm, offset - max_ppm * scale, False),
+                    self._ppm_index(min_ppm, offset - min_ppm * scale, True))
+
+        i_max_ppm = _first_index(offset - max_ppm * scale, self.npts,
+                                 lambda index: self._ppm_at(index) <= max_ppm)
+        i_min_ppm = _first_index(offset - min_ppm * scale, self.npts,
+                                 lambda index: self._ppm_at(index) < min_ppm)
+        return (i_max_ppm, i_min_ppm)
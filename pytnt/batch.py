@@ -0,0 +1,175 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Load many .tnt files in parallel
+"""
+
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+
+from .processTNT import TNTfile
+
+
+LoadResult = namedtuple('LoadResult', ['path', 'tnt', 'spectrum', 'error'])
+
+
+class TNTCollection:
+
+    """The results of loading a batch of .tnt files
+
+    Iterating over the collection gives LoadResult tuples of
+    (path, tnt, spectrum, error) in the order the paths were given.
+    For files that could not be loaded, tnt and spectrum are None and error
+    is the exception that was raised."""
+
+    def __init__(self, results):
+        self.results = list(results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    @property
+    def paths(self):
+        return [result.path for result in self.results]
+
+    @property
+    def files(self):
+        """The TNTfile objects (None where loading failed)"""
+        return [result.tnt for result in self.results]
+
+    @property
+    def spectra(self):
+        """The LBfft output for each file (None if not requested or failed)"""
+        return [result.spectrum for result in self.results]
+
+    @property
+    def errors(self):
+        """A dict mapping the paths of the files that failed to the errors"""
+        return OrderedDict((result.path, result.error)
+                           for result in self.results
+                           if result.error is not None)
+
+
+def _load_one(path, tntfile_kwargs, lbfft_kwargs):
+    try:
+        tnt = TNTfile(path, **tntfile_kwargs)
+        if lbfft_kwargs is None:
+            spectrum = None
+        else:
+            spectrum = tnt.LBfft(**lbfft_kwargs)
+    except Exception as err:
+        return LoadResult(path, None, None, err)
+    return LoadResult(path, tnt, spectrum, None)
+
+
+def load_many(paths, workers=None, processes=False, lbfft=None,
+              **tntfile_kwargs):
+    """Open a list of .tnt files in a thread or process pool.
+
+    Errors in individual files do not stop the rest of the batch; they are
+    reported in the `errors` attribute of the returned collection.
+
+    Args:
+        paths: The paths of the files to open
+        workers: The number of worker threads or processes. Defaults to the
+            number of CPUs; if 1, the files are loaded in the calling thread
+        processes: If True, use a process pool rather than a thread pool.
+            This is faster when the LBfft step dominates, at the cost of
+            copying the results back to the parent process.
+        lbfft: If not None, a dict of keyword arguments to pass to
+            TNTfile.LBfft, which is then run in the workers
+        tntfile_kwargs: Extra keyword arguments passed to TNTfile
+
+    Returns:
+        A TNTCollection with one result per path, in the same order as paths
+    """
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        results = [_load_one(path, tntfile_kwargs, lbfft) for path in paths]
+    else:
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with Executor(max_workers=workers) as executor:
+            futures = [executor.submit(_load_one, path, tntfile_kwargs, lbfft)
+                       for path in paths]
+            results = [future.result() for future in futures]
+
+    return TNTCollection(results)
+
+
+def _prefetch_DATA(tnt, chunk_size=1 << 20):
+    """Get the OS to start reading the DATA section into the page cache"""
+    section = tnt.tnt_sections['DATA']
+    with open(tnt.filename, 'rb') as tntfile:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(tntfile.fileno(), section['offset'],
+                             section['length'], os.POSIX_FADV_WILLNEED)
+            return
+        # Otherwise read through the section, so it is at least in the cache
+        tntfile.seek(section['offset'])
+        buffer = memoryview(bytearray(chunk_size))
+        remaining = section['length']
+        while remaining > 0:
+            n_read = tntfile.readinto(buffer[:min(chunk_size, remaining)])
+            if not n_read:
+                break
+            remaining -= n_read
+
+
+def _open_prefetched(path, tntfile_kwargs):
+    try:
+        tnt = TNTfile(path, **tntfile_kwargs)
+        _prefetch_DATA(tnt)
+    except Exception as err:
+        return LoadResult(path, None, None, err)
+    return LoadResult(path, tnt, None, None)
+
+
+def iter_files(paths, prefetch=2, **tntfile_kwargs):
+    """Open a sequence of .tnt files one after another, reading ahead.
+
+    While the caller is working on one file, the next prefetch files are
+    opened in background threads and the OS is asked to read their DATA
+    sections into the page cache (with posix_fadvise where available), so
+    that accessing DATA doesn't have to wait for the disk or network.
+    At most prefetch files are opened ahead of the one being used.
+
+    Args:
+        paths: The paths of the files to open (can be a generator)
+        prefetch: The number of files to read ahead; if 0, the files are
+            simply opened in turn
+        tntfile_kwargs: Extra keyword arguments passed to TNTfile
+
+    Yields:
+        LoadResult tuples (path, tnt, None, error) in the order of paths.
+        As with load_many, errors don't stop the iteration.
+    """
+    paths = iter(paths)
+    if prefetch < 1:
+        for path in paths:
+            yield _open_prefetched(path, tntfile_kwargs)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    try:
+        for path in paths:
+            pending.append(executor.submit(_open_prefetched, path, tntfile_kwargs))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Fourier transform of the FIDs over a narrow band of frequencies
+
+The chirp z-transform evaluates the discrete Fourier transform at any
+evenly spaced set of frequencies, not just the npts_ft frequencies of a
+zero-filled FFT. It uses Bluestein's algorithm, which turns the transform
+into a convolution done with FFTs of length about npts + m (for m output
+points), so the cost doesn't depend on how much the FID is zero-filled.
+
+Frequencies are given in points of an equivalent npts_ft point FFT, so
+that frequency nu (which need not be an integer) is point nu of
+numpy.fft.fft(fid, npts_ft), counting from zero at index 0.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from . import fftbackend
+from .utils import CACHE_SIZE, _readonly
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _chirps(npts, m, nfft, nu0, dnu, npts_ft, dtype):
+    """The chirps that the input and output are multiplied by, and the FFT of
+    the chirp that they are convolved with"""
+    alpha = dnu / npts_ft
+    n = np.arange(npts, dtype=float)
+    # n * n is exact in floating point for any realistic number of points
+    pre = np.exp(-1j * np.pi * (2 * nu0 / npts_ft * n + alpha * n * n))
+    j = np.arange(m, dtype=float)
+    post = np.exp(-1j * np.pi * alpha * j * j)
+
+    # The convolution kernel runs from -(npts - 1) to m - 1, wrapped around
+    kernel = np.zeros(nfft, dtype=complex)
+    kernel[:m] = np.exp(1j * np.pi * alpha * j * j)
+    kernel[nfft - npts + 1:] = np.exp(1j * np.pi * alpha * n[:0:-1] ** 2)
+    kernel_fft = np.fft.fft(kernel) / nfft  # Includes the 1/nfft of the ifft
+    return (_readonly(pre.astype(dtype)), _readonly(post.astype(dtype)),
+            _readonly(kernel_fft.astype(dtype)))
+
+
+def _broadcast_shape(vector, ndim):
+    return vector.reshape(vector.shape + (1,) * (ndim - 1))
+
+
+def zoom_fft(fids, m, nu0, dnu=1.0, npts_ft=None, dtype=complex,
+             backend=None, workers=None):
+    """Evaluate the Fourier transform of fids along axis 0 at m frequencies
+
+    The result is the same as numpy.fft.fft(fids, npts_ft, axis=0) evaluated
+    at frequencies nu0, nu0 + dnu, ..., nu0 + (m - 1) * dnu. For example,
+    zoom_fft(fids, 100, 300, 1, 4096) is numpy.fft.fft(fids, 4096, axis=0)[300:400].
+
+    Args:
+        fids: Array of FIDs, with time along axis 0
+        m: Number of output points
+        nu0: The first frequency (in points of an npts_ft point FFT)
+        dnu: The spacing between the frequencies (in the same units)
+        npts_ft: Length of the equivalent FFT, by default the length of fids
+        dtype: The complex dtype of the result
+        backend, workers: Passed on to fftbackend.fft
+
+    Returns:
+        Array with m points along axis 0
+    """
+    npts = fids.shape[0]
+    if npts_ft is None:
+        npts_ft = npts
+    dtype = np.dtype(dtype)
+    if m <= 0 or npts == 0:
+        return np.zeros((max(m, 0),) + fids.shape[1:], dtype=dtype)
+
+    nfft = fftbackend.next_fast_len(npts + m - 1)
+    pre, post, kernel_fft = _chirps(int(npts), int(m), int(nfft), float(nu0),
+                                    float(dnu), int(npts_ft), dtype)
+    ndim = fids.ndim
+    spectrum = fftbackend.fft(fids * _broadcast_shape(pre, ndim), n=nfft, axis=0,
+                              backend=backend, workers=workers)
+    spectrum = spectrum.astype(dtype, copy=False)
+    spectrum *= _broadcast_shape(kernel_fft, ndim)
+    # The inverse FFT, done as a forward FFT of the complex conjugate
+    np.conjugate(spectrum, out=spectrum)
+    convolved = fftbackend.fft(spectrum, n=nfft, axis=0,
+                               backend=backend, workers=workers)[:m]
+    convolved = np.conjugate(convolved).astype(dtype, copy=False)
+    convolved *= _broadcast_shape(post, ndim)
+    return convolved
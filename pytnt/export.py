@@ -0,0 +1,220 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Convert .tnt files to chunked, compressed HDF5 or Zarr stores
+
+Each store contains:
+
+    DATA: the raw FIDs as a 4-D complex64 array
+    fid_times: the time axis of the FIDs (in s)
+    spectrum: (optional) the output of TNTfile.LBfft
+    freq_Hz, freq_ppm: the frequency axes of the spectrum
+    DELAY/<name>: the delay tables
+    TMAG, TMG2: groups with the acquisition and processing parameters as
+        attributes
+
+The 4-D arrays are chunked so that each chunk holds one or more whole
+spectra, so reading a slice of spectra only decompresses those spectra.
+
+h5py is needed for HDF5 output and zarr for Zarr output; they are imported
+only when needed.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import os.path
+import sys
+
+import numpy as np
+
+from . import profiling
+from .processTNT import TNTfile
+
+
+# Aim for chunks of about this many bytes
+CHUNK_BYTES = 1 << 18
+
+
+def _spectrum_chunks(shape, itemsize, chunk_bytes):
+    """Chunk shape holding whole spectra, split along dimension 1"""
+    n1 = max(chunk_bytes // (shape[0] * itemsize), 1)
+    return (shape[0], min(n1, max(shape[1], 1)), 1, 1)
+
+
+def _struct_attrs(tnt, struct, prefix=''):
+    """Convert a TMAG or TMG2 struct to a dict of attribute values"""
+    attrs = {}
+    for fieldname in struct.dtype.names:
+        if fieldname.startswith('space') or fieldname in ['Boolean_space', 'unused']:
+            continue
+        value = struct[fieldname]
+        if value.dtype.names is not None:
+            attrs.update(_struct_attrs(tnt, value, prefix + fieldname + '.'))
+        elif value.dtype.kind == 'S':
+            if value.ndim == 0:
+                attrs[prefix + fieldname] = tnt.decode(value.tobytes().rstrip(b'\0'))
+            else:
+                attrs[prefix + fieldname] = [tnt.decode(v) for v in value]
+        else:
+            attrs[prefix + fieldname] = value.tolist()
+    return attrs
+
+
+def _write_store(root, tnt, lbfft, chunk_bytes, dataset_kwargs):
+    """Write the contents of tnt into an h5py or zarr group"""
+    DATA = tnt.DATA
+    chunks = _spectrum_chunks(DATA.shape, DATA.itemsize, chunk_bytes)
+    ds = root.create_dataset('DATA', shape=DATA.shape, dtype=DATA.dtype,
+                             chunks=chunks, **dataset_kwargs)
+    for i in range(0, DATA.shape[1], chunks[1]):
+        with profiling.stage('export', tnt.filename) as record:
+            block = DATA[:, i:i + chunks[1]]
+            record['bytes_read'] = block.nbytes
+            ds[:, i:i + chunks[1]] = block
+    root.create_dataset('fid_times', data=np.asarray(tnt.fid_times()))
+
+    if lbfft is not None:
+        lbfft = dict(lbfft)
+        dtype = np.dtype(lbfft.setdefault('dtype', np.complex64))
+        npts_ft = DATA.shape[0] * 2 ** lbfft.get('zf', 0)
+        shape = (npts_ft,) + DATA.shape[1:]
+        ds = root.create_dataset(
+            'spectrum', shape=shape, dtype=dtype,
+            chunks=_spectrum_chunks(shape, dtype.itemsize, chunk_bytes),
+            **dataset_kwargs)
+        lbfft.setdefault('max_memory', 64 * chunk_bytes)
+        for index, block in tnt.iter_LBfft(**lbfft):
+            with profiling.stage('export', tnt.filename):
+                ds[index] = block
+        ds.attrs.update({key: value for key, value in lbfft.items()
+                         if np.isscalar(value) and key != 'dtype'})
+        ds.attrs['dtype'] = dtype.name
+        axis = tnt.axes[0].with_npts(npts_ft)
+        root.create_dataset('freq_Hz', data=np.asarray(axis.freq_Hz))
+        root.create_dataset('freq_ppm', data=np.asarray(axis.freq_ppm))
+
+    delay_group = root.create_group('DELAY')
+    for name, delay in tnt.DELAY.items():
+        delay_group.create_dataset(name, data=delay)
+
+    for struct_name in ['TMAG', 'TMG2']:
+        group = root.create_group(struct_name)
+        group.attrs.update(_struct_attrs(tnt, getattr(tnt, struct_name)))
+    root.attrs['source'] = os.path.abspath(tnt.filename)
+    root.attrs['tntmagic'] = tnt.decode(tnt.tntmagic)
+
+
+def to_hdf5(tnt, path, lbfft=None, compression='gzip', chunk_bytes=CHUNK_BYTES):
+    """Save the contents of a TNTfile to an HDF5 file.
+
+    Args:
+        tnt: A TNTfile, or the path of a .tnt file
+        path: Path of the HDF5 file to write
+        lbfft: If not None, a dict of keyword arguments for TNTfile.LBfft;
+            the spectra are then also saved (in complex64 unless a dtype is
+            given). They are computed in blocks, so they never all have to
+            be in memory.
+        compression: HDF5 compression filter for the large arrays
+        chunk_bytes: Approximate size of each chunk of the 4-D arrays
+    """
+    import h5py
+    if not isinstance(tnt, TNTfile):
+        tnt = TNTfile(tnt)
+    with h5py.File(path, 'w') as root:
+        _write_store(root, tnt, lbfft, chunk_bytes,
+                     {'compression': compression, 'shuffle': compression is not None})
+
+
+def to_zarr(tnt, path, lbfft=None, chunk_bytes=CHUNK_BYTES):
+    """Save the contents of a TNTfile to a Zarr directory store.
+
+    The arguments are the same as for to_hdf5, except that Zarr's default
+    compressor is used."""
+    import zarr
+    if not isinstance(tnt, TNTfile):
+        tnt = TNTfile(tnt)
+    root = zarr.open_group(path, mode='w')
+    _write_store(root, tnt, lbfft, chunk_bytes, {})
+
+
+_writers = {'hdf5': (to_hdf5, '.h5'),
+            'zarr': (to_zarr, '.zarr')}
+
+
+def _convert_one(src, dest, fmt, lbfft):
+    try:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        _writers[fmt][0](src, dest, lbfft=lbfft)
+    except Exception as err:
+        return '%s: %s' % (type(err).__name__, err)
+    return None
+
+
+def convert_tree(src_dir, dest_dir, fmt='hdf5', lbfft=None, workers=None,
+                 overwrite=False):
+    """Convert all the .tnt files under src_dir, in parallel processes.
+
+    The converted files are written under dest_dir with the same relative
+    paths. Files which have already been converted since the .tnt file was
+    last modified are skipped unless overwrite is True.
+
+    Returns:
+        A list of (source path, error message or None) for the files converted
+    """
+    extension = _writers[fmt][1]
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        for fname in sorted(filenames):
+            if not fname.endswith('.tnt'):
+                continue
+            src = os.path.join(dirpath, fname)
+            dest = os.path.join(dest_dir, os.path.relpath(src, src_dir))
+            dest = dest[:-len('.tnt')] + extension
+            if (not overwrite and os.path.exists(dest)
+                    and os.path.getmtime(dest) >= os.path.getmtime(src)):
+                continue
+            jobs.append((src, dest))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_convert_one, src, dest, fmt, lbfft)
+                   for src, dest in jobs]
+        return [(src, future.result()) for (src, dest), future in zip(jobs, futures)]
+
+
+## Command line interface
+
+parser = argparse.ArgumentParser(
+    description='Convert a directory tree of .tnt files to HDF5 or Zarr')
+parser.add_argument('src_dir', help="Directory to search for .tnt files")
+parser.add_argument('dest_dir', help="Directory to write the converted files to")
+parser.add_argument('--format', choices=sorted(_writers), default='hdf5')
+parser.add_argument('--spectra', action='store_true',
+                    help="Also save the Fourier transformed spectra")
+parser.add_argument('--lb', type=float, default=0,
+                    help="Line broadening for the spectra (in Hz)")
+parser.add_argument('--zf', type=int, default=0,
+                    help="Zero fill the spectra to npts * 2**zf points")
+parser.add_argument('--workers', '-j', type=int, default=None,
+                    help="Number of processes to use")
+parser.add_argument('--overwrite', action='store_true',
+                    help="Convert files even if they are already up to date")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    lbfft = {'LB': args.lb, 'zf': args.zf} if args.spectra else None
+    results = convert_tree(args.src_dir, args.dest_dir, args.format, lbfft,
+                           args.workers, args.overwrite)
+    n_failed = 0
+    for src, error in results:
+        if error is not None:
+            print("%s: %s" % (src, error), file=sys.stderr)
+            n_failed += 1
+    print("%d files converted, %d failed" % (len(results) - n_failed, n_failed))
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Selectable FFT implementations for LBfft
+
+Three backends are supported:
+
+    'scipy': scipy.fft, which can split the transforms over several threads
+    'pyfftw': pyFFTW, with the most recently used plans kept between calls
+              and optional wisdom
+    'numpy': numpy.fft, single-threaded but always available
+
+By default the first of these that can be imported is used. The backend
+and the number of threads can be set globally with set_backend, or for a
+single call with the fft_backend and workers arguments of TNTfile.LBfft.
+"""
+
+from collections import OrderedDict, namedtuple
+import os
+import threading
+
+import numpy as np
+
+
+def _resolve_workers(workers):
+    """Convert a scipy-style workers argument to a number of threads"""
+    ncpus = os.cpu_count() or 1
+    if workers is None:
+        return ncpus
+    if workers < 0:
+        return max(ncpus + 1 + workers, 1)
+    return workers
+
+
+def _load_scipy():
+    import scipy.fft
+
+    def fft(a, n, axis, workers):
+        return scipy.fft.fft(a, n=n, axis=axis, workers=_resolve_workers(workers))
+    return fft
+
+
+# Most pyFFTW plans to keep, and the largest total size of their arrays.
+# Each plan holds on to its input and output arrays (the output being the
+# result of its most recent call), so the plans for large unchunked
+# transforms are not kept at all.
+PLAN_CACHE_SIZE = 32
+PLAN_CACHE_BYTES = 1 << 26
+
+PlanCacheInfo = namedtuple('PlanCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+_plan_stats = {'hits': 0, 'misses': 0}
+
+
+def _plan_nbytes(plan):
+    return plan.input_array.nbytes + plan.output_array.nbytes
+
+
+def _pyfftw_plan(shape, dtype, n, axis, threads):
+    """Return a (plan, lock) pair, from the cache if possible"""
+    key = (shape, dtype, n, axis, threads)
+    with _plans_lock:
+        if key in _plans:
+            _plans.move_to_end(key)
+            _plan_stats['hits'] += 1
+            return _plans[key]
+        _plan_stats['misses'] += 1
+
+    import pyfftw
+    import pyfftw.builders
+    plan = pyfftw.builders.fft(pyfftw.empty_aligned(shape, dtype=dtype),
+                               n=n, axis=axis, threads=threads)
+    # A plan has internal buffers so it can only be used by one thread at once
+    entry = (plan, threading.Lock())
+    if _plan_nbytes(plan) <= PLAN_CACHE_BYTES:
+        with _plans_lock:
+            _plans[key] = entry
+            total = sum(_plan_nbytes(cached) for cached, _ in _plans.values())
+            while len(_plans) > PLAN_CACHE_SIZE or total > PLAN_CACHE_BYTES:
+                evicted, _ = _plans.popitem(last=False)[1]
+                total -= _plan_nbytes(evicted)
+    return entry
+
+
+def _load_pyfftw():
+    import pyfftw
+
+    def fft(a, n, axis, workers):
+        a = np.asarray(a)
+        plan, lock = _pyfftw_plan(a.shape, a.dtype, n, axis,
+                                  _resolve_workers(workers))
+        out = pyfftw.empty_aligned(plan.output_shape, dtype=plan.output_dtype)
+        with lock:
+            return plan(a, out)
+    return fft
+
+
+def _load_numpy():
+
+    def fft(a, n, axis, workers):
+        return np.fft.fft(a, n=n, axis=axis)
+    return fft
+
+
+_loaders = OrderedDict([('scipy', _load_scipy),
+                        ('pyfftw', _load_pyfftw),
+                        ('numpy', _load_numpy)])
+_loaded = {}
+
+_default_backend = None
+_default_workers = None
+_auto_backend = None
+
+
+def _get_fft(name):
+    if name not in _loaders:
+        raise ValueError("Unknown FFT backend '%s', must be one of %s" % (
+            name, ', '.join(_loaders)))
+    if name not in _loaded:
+        _loaded[name] = _loaders[name]()
+    return _loaded[name]
+
+
+def available_backends():
+    """Return the names of the FFT backends which can be imported"""
+    available = []
+    for name in _loaders:
+        try:
+            _get_fft(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def get_backend():
+    """Return the name of the FFT backend used by default"""
+    global _auto_backend
+    if _default_backend is not None:
+        return _default_backend
+    if _auto_backend is None:
+        _auto_backend = available_backends()[0]
+    return _auto_backend
+
+
+def set_backend(name=None, workers=None):
+    """Set the FFT backend and number of threads used by default.
+
+    Args:
+        name: 'scipy', 'pyfftw' or 'numpy', or None to use the first one
+            which is available. Raises ImportError if the requested backend
+            is not installed.
+        workers: Number of threads to use for the FFT; negative numbers
+            count back from the number of CPUs (-1 means all of them).
+            None means all CPUs.
+    """
+    global _default_backend, _default_workers
+    if name is not None:
+        _get_fft(name)
+    _default_backend = name
+    _default_workers = workers
+
+
+def fft(a, n=None, axis=-1, backend=None, workers=None):
+    """Compute the one-dimensional FFT of a along axis.
+
+    The single precision types are preserved by the scipy and pyfftw
+    backends; numpy.fft before numpy 2.0 always returns complex128.
+
+    Args:
+        a: Input array
+        n: Length of the transform (the input is zero-filled to this length)
+        axis: Axis to transform along
+        backend: Name of the backend to use instead of the default
+        workers: Number of threads to use instead of the default
+    """
+    if backend is None:
+        backend = get_backend()
+    if workers is None:
+        workers = _default_workers
+    return _get_fft(backend)(a, n, axis, workers)
+
+
+def next_fast_len(n):
+    """Return the smallest length >= n which can be transformed quickly"""
+    try:
+        import scipy.fft
+    except ImportError:
+        return 1 << max(int(n) - 1, 0).bit_length()
+    return scipy.fft.next_fast_len(int(n))
+
+
+def plan_cache_info():
+    """Return the hit/miss statistics of the pyFFTW plan cache"""
+    with _plans_lock:
+        return PlanCacheInfo(_plan_stats['hits'], _plan_stats['misses'],
+                             PLAN_CACHE_SIZE, len(_plans))
+
+
+def plan_cache_clear():
+    with _plans_lock:
+        _plans.clear()
+        _plan_stats['hits'] = _plan_stats['misses'] = 0
+
+
+def export_wisdom(filename):
+    """Save the pyFFTW wisdom (the knowledge of the best FFT plans)"""
+    import pyfftw
+    with open(filename, 'wb') as wisdom_file:
+        for wisdom in pyfftw.export_wisdom():
+            wisdom_file.write(len(wisdom).to_bytes(8, 'little'))
+            wisdom_file.write(wisdom)
+
+
+def import_wisdom(filename):
+    """Load pyFFTW wisdom saved by export_wisdom"""
+    import pyfftw
+    wisdom = []
+    with open(filename, 'rb') as wisdom_file:
+        for _ in range(3):  # double, single and long double precision
+            length = int.from_bytes(wisdom_file.read(8), 'little')
+            wisdom.append(wisdom_file.read(length))
+    return pyfftw.import_wisdom(tuple(wisdom))
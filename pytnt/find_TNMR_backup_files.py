@@ -26,6 +26,8 @@ import os
 import os.path
 import re
 import subprocess 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import argparse
 
@@ -65,6 +67,104 @@ def delete_git(dirpath, fname):
         subprocess.check_call(['git', 'rm', fname])
 
 
+def _max_arg_bytes():
+    """Space available for command line arguments, leaving some headroom"""
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 1 << 17  # The smallest limit likely to be found
+    env_size = sum(len(key) + len(value) + 2 + 8 for key, value in os.environ.items())
+    return max(arg_max - env_size - 4096, 4096)
+
+
+class BatchedRemove:
+
+    """An action which collects the backup files and then removes them
+    with one command per directory (or a few, if there are too many files
+    to fit on one command line).
+
+    The files are only removed when finish() is called, which
+    find_TNMR_backup_files does after the search."""
+
+    def __init__(self, command=None, dry_run=False, max_arg_bytes=None,
+                 log_std=sys.stderr):
+        """
+        Args:
+            command: Command to remove files with, e.g. ['git', 'rm', '--'];
+                the file names are appended and it is run in the directory
+                containing them. If None the files are deleted with os.unlink.
+            dry_run: If True, don't remove anything, just print a summary
+                of what would be done
+            max_arg_bytes: Maximum size of the arguments of each command,
+                by default as much as the OS allows
+            log_std: File to print the dry run summary to
+        """
+        self.command = command
+        self.dry_run = dry_run
+        if max_arg_bytes is None:
+            max_arg_bytes = _max_arg_bytes()
+        self.max_arg_bytes = max_arg_bytes
+        self.log_std = log_std
+        self.files = OrderedDict()  # Lists of file names, keyed by directory
+
+    def __call__(self, dirpath, fname):
+        self.files.setdefault(dirpath, []).append(fname)
+
+    @staticmethod
+    def _arg_size(arg):
+        # The string, its terminating NUL and the pointer to it
+        return len(os.fsencode(arg)) + 1 + 8
+
+    def _chunks(self, fnames):
+        """Split fnames into lists which fit on a command line"""
+        base_size = sum(self._arg_size(arg) for arg in self.command)
+        chunk = []
+        size = base_size
+        for fname in fnames:
+            arg_size = self._arg_size(fname)
+            if chunk and size + arg_size > self.max_arg_bytes:
+                yield chunk
+                chunk = []
+                size = base_size
+            chunk.append(fname)
+            size += arg_size
+        if chunk:
+            yield chunk
+
+    def finish(self):
+        """Remove all the files collected so far
+
+        Returns:
+            The number of commands run (or which would have been run)
+        """
+        n_files = 0
+        n_commands = 0
+        for dirpath, fnames in self.files.items():
+            n_files += len(fnames)
+            if self.command is None:
+                if not self.dry_run:
+                    for fname in fnames:
+                        os.unlink(os.path.join(dirpath, fname))
+                continue
+            for chunk in self._chunks(fnames):
+                n_commands += 1
+                if not self.dry_run:
+                    subprocess.check_call(self.command + chunk, cwd=dirpath)
+        if self.dry_run:
+            how = "with '%s' (%d commands)" % (' '.join(self.command), n_commands) \
+                if self.command is not None else 'with unlink'
+            print("Would remove %d files in %d directories %s" % (
+                n_files, len(self.files), how), file=self.log_std)
+        self.files = OrderedDict()
+        return n_commands
+
+
+GIT_RM = ['git', 'rm', '--']
+SVN_RM = ['svn', 'rm', '--']
+
+
 ## Handle command line arguments
 
 parser = argparse.ArgumentParser(description='Find and process TNMR backup files')
@@ -87,6 +187,14 @@ parser.add_argument('-svnrm', action='append_const',
 parser.add_argument('--quiet', '-q', action='store_const', dest='log_std',
                     const=open('/dev/null', 'w'), default=sys.stderr,
                     help="Don't print reasons for omitting files")
+parser.add_argument('--threads', '-j', type=int, default=1,
+                    help="Number of threads to use to read directories")
+parser.add_argument('--verify', action='store_true',
+                    help="Only select backup files whose complete spectra are "
+                    "identical to the start of the base file's data")
+parser.add_argument('--dry-run', '-n', action='store_true',
+                    help="Don't delete anything, just print a summary of what "
+                    "-delete, -gitrm or -svnrm would do")
 
 def main():
     args = parser.parse_args()
@@ -94,42 +202,244 @@ def main():
     if args.actions is None:
         actions = [print_filepath]  # Default action
     else:
-        actions = args.actions
+        # Remove the files in batches rather than one at a time
+        batched = {delete: BatchedRemove(None, args.dry_run),
+                   delete_git: BatchedRemove(GIT_RM, args.dry_run),
+                   delete_svn: BatchedRemove(SVN_RM, args.dry_run)}
+        actions = [batched.get(act, act) for act in args.actions]
 
-    find_TNMR_backup_files(args.path_to_search, actions, args.log_std)
+    find_TNMR_backup_files(args.path_to_search, actions, args.log_std,
+                           args.threads, args.verify)
 
 
 ## Search the file system
-def find_TNMR_backup_files(path_to_search, actions, log_std):
-    for dirpath, dirnames, filenames in os.walk(path_to_search):
-        for fname in filenames:
-            if re.match('.*\.tnt_\d+\.tnt$', fname):
-                for act in actions:
-                    act(dirpath, fname)
-            elif re.match('.*_\d+\.tnt$', fname):
-                base_fname = re.sub('_\d+\.tnt$', '.tnt', fname)
-                if base_fname in filenames:
-                    my_stat = os.stat(os.path.join(dirpath, fname))
-                    base_stat = os.stat(os.path.join(dirpath, base_fname))
-                    if my_stat.st_size > base_stat.st_size:
-                        print("%s is bigger than %s, keeping" % (fname, base_fname), file=log_std)
-                    elif my_stat.st_mtime > base_stat.st_mtime:
-                        print("%s is newer than %s, keeping" % (fname, base_fname), file=log_std)
-                    
-                    ## I had the idea of checking for file age difference but the
-                    ## files I have all seem to have much bigger mtime differences
-                    ## than would make sense based on when they were acquired.
-#                    elif my_stat.st_mtime < (base_stat.st_mtime - 3600 * 24 * 7):
-#                        my_mtime = time.gmtime(my_stat.st_mtime)
-#                        base_mtime = time.gmtime(base_stat.st_mtime)
-#                        print ("%s is more than a week older than %s, keeping" % (fname, base_fname), file=log_std)
-#                        print ("%s was last modified at %s" % (fname, time.strftime('%c', my_mtime)), file=sys.stderr)
-#                        print ("%s was last modified at %s" % (base_fname, time.strftime('%c', base_mtime)), file=sys.stderr)
-                    else:
-                        for act in actions:
-                            act(dirpath, fname)
+
+_backup_of_backup_re = re.compile(r'.*\.tnt_\d+\.tnt$')
+_numbered_re = re.compile(r'.*_\d+\.tnt$')
+_number_suffix_re = re.compile(r'_\d+\.tnt$')
+
+
+def _scan_dir(dirpath):
+    """List a directory, splitting the entries into directories and files
+    in the same way as os.walk.
+
+    Returns:
+        A tuple (subdirs, files) of lists of DirEntry objects, or None if
+        the directory can't be read
+    """
+    try:
+        with os.scandir(dirpath) as scandir_it:
+            entries = list(scandir_it)
+    except OSError:
+        return None
+    subdirs = []
+    files = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(entry)
+            continue
+        try:
+            is_symlink = entry.is_symlink()
+        except OSError:
+            is_symlink = False
+        if not is_symlink:  # Not followed, like os.walk
+            subdirs.append(entry)
+    return subdirs, files
+
+
+def _walk(top, executor=None, max_pending=0):
+    """Generate (dirpath, file entries) in the same order as os.walk
+
+    If executor is given, up to max_pending of the directories which will
+    be walked next are scanned ahead in the background."""
+    stack = [[top, None]]  # [dirpath, future], with the next one at the end
+    n_pending = 0
+    try:
+        while stack:
+            dirpath, future = stack.pop()
+            if future is None:
+                scanned = _scan_dir(dirpath)
+            else:
+                n_pending -= 1
+                scanned = future.result()
+            if scanned is not None:
+                subdirs, files = scanned
+                stack.extend([entry.path, None] for entry in reversed(subdirs))
+            if executor is not None:
+                for item in reversed(stack[-max_pending:]):
+                    if n_pending >= max_pending:
+                        break
+                    if item[1] is None:
+                        item[1] = executor.submit(_scan_dir, item[0])
+                        n_pending += 1
+            if scanned is not None:
+                yield dirpath, files
+    finally:
+        # Don't leave scans queued if the walk is abandoned
+        for dirpath, future in stack:
+            if future is not None:
+                future.cancel()
+
+
+def _select_backups(dirpath, files, log_std):
+    """Generate (backup name, base file name) for the backup files in one
+    directory"""
+    by_name = {entry.name: entry for entry in files}
+    for entry in files:
+        fname = entry.name
+        if _backup_of_backup_re.match(fname):
+            yield fname, _number_suffix_re.sub('', fname)
+        elif _numbered_re.match(fname):
+            base_fname = _number_suffix_re.sub('.tnt', fname)
+            base_entry = by_name.get(base_fname)
+            if base_entry is not None:
+                # DirEntry caches the result, so each base file is only
+                # stat'ed once however many backups it has
+                my_stat = entry.stat()
+                base_stat = base_entry.stat()
+                if my_stat.st_size > base_stat.st_size:
+                    print("%s is bigger than %s, keeping" % (fname, base_fname), file=log_std)
+                elif my_stat.st_mtime > base_stat.st_mtime:
+                    print("%s is newer than %s, keeping" % (fname, base_fname), file=log_std)
+
+                ## I had the idea of checking for file age difference but the
+                ## files I have all seem to have much bigger mtime differences
+                ## than would make sense based on when they were acquired.
+#                elif my_stat.st_mtime < (base_stat.st_mtime - 3600 * 24 * 7):
+#                    my_mtime = time.gmtime(my_stat.st_mtime)
+#                    base_mtime = time.gmtime(base_stat.st_mtime)
+#                    print ("%s is more than a week older than %s, keeping" % (fname, base_fname), file=log_std)
+#                    print ("%s was last modified at %s" % (fname, time.strftime('%c', my_mtime)), file=sys.stderr)
+#                    print ("%s was last modified at %s" % (base_fname, time.strftime('%c', base_mtime)), file=sys.stderr)
                 else:
-                    print('%s does not have a matching base file %s, keeping' % (fname, base_fname), file=log_std)
+                    yield fname, base_fname
+            else:
+                print('%s does not have a matching base file %s, keeping' % (fname, base_fname), file=log_std)
+
+
+def verify_backup(backup_path, base_path, chunk_size=1 << 22):
+    """Check that the data in a backup file is also in the base file.
+
+    The complete spectra in the backup must be identical, byte for byte, to
+    the start of the DATA section of the base file, and the dimensions must
+    be consistent. The DATA sections are compared a chunk at a time, so
+    the files are never read into memory.
+
+    Returns:
+        None if the backup is redundant, otherwise the reason it isn't
+    """
+    from .processTNT import TNTfile
+
+    try:
+        backup = TNTfile(backup_path, lazy=True)
+        base = TNTfile(base_path, lazy=True)
+    except (OSError, ValueError, AssertionError, KeyError) as err:
+        return "can't be read: %s" % err
+
+    backup_npts = backup.actual_npts.tolist()
+    base_npts = base.actual_npts.tolist()
+    # Spectra are stored with dimension 1 varying fastest, so the backup is
+    # only a prefix of the base file if the dimensions below the highest
+    # one it has started filling are the same
+    highest = max([d for d in range(1, 4) if backup_npts[d] > 1], default=1)
+    if backup_npts[:highest] != base_npts[:highest]:
+        return "its dimensions %s don't match %s" % (backup_npts, base_npts)
+
+    n_complete = backup_npts[1] * backup_npts[2] * backup_npts[3]
+    if backup.scans != backup.actual_scans:
+        n_complete -= 1  # The last spectrum was not finished
+    length = n_complete * backup_npts[0] * 8
+    if length > base.tnt_sections['DATA']['length']:
+        return "it has more complete spectra than the base file"
+
+    with open(backup_path, 'rb') as backup_file, open(base_path, 'rb') as base_file:
+        backup_file.seek(backup.tnt_sections['DATA']['offset'])
+        base_file.seek(base.tnt_sections['DATA']['offset'])
+        compared = 0
+        while compared < length:
+            size = min(chunk_size, length - compared)
+            backup_chunk = backup_file.read(size)
+            base_chunk = base_file.read(size)
+            if len(backup_chunk) != size or len(base_chunk) != size:
+                return "its DATA section is truncated"
+            if backup_chunk != base_chunk:
+                return "its DATA differs after %d bytes" % compared
+            compared += size
+    return None
+
+
+def iter_TNMR_backup_files(path_to_search, log_std, threads=1, verify=False):
+    """Generate (dirpath, fname) for each backup file under path_to_search.
+
+    The directories are visited in the same order as os.walk. If threads
+    is more than 1, the directory listings are read ahead in that many
+    background threads, which helps a lot on network file systems; the
+    files are still selected in the calling thread.
+
+    If verify is True, each backup file must also pass verify_backup; the
+    checks run in a pool of threads background threads, and files which
+    fail are kept.
+    """
+    if threads > 1:
+        executor = ThreadPoolExecutor(max_workers=threads)
+    else:
+        executor = None
+    try:
+        candidates = ((dirpath, fname, base_fname)
+                      for dirpath, files in _walk(path_to_search, executor, 4 * threads)
+                      for fname, base_fname in _select_backups(dirpath, files, log_std))
+        if verify:
+            yield from _verified(candidates, log_std, threads)
+        else:
+            for dirpath, fname, base_fname in candidates:
+                yield dirpath, fname
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _verified(candidates, log_std, threads):
+    """Run verify_backup on the candidates in parallel, keeping their order"""
+    max_pending = 4 * max(threads, 1)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        pending = deque()
+        for dirpath, fname, base_fname in candidates:
+            future = executor.submit(verify_backup, os.path.join(dirpath, fname),
+                                     os.path.join(dirpath, base_fname))
+            pending.append((dirpath, fname, base_fname, future))
+            while pending and (len(pending) >= max_pending or pending[0][3].done()):
+                yield from _check_verified(*pending.popleft(), log_std=log_std)
+        while pending:
+            yield from _check_verified(*pending.popleft(), log_std=log_std)
+
+
+def _check_verified(dirpath, fname, base_fname, future, log_std):
+    reason = future.result()
+    if reason is None:
+        yield dirpath, fname
+    else:
+        print("%s does not match %s: %s, keeping" % (fname, base_fname, reason),
+              file=log_std)
+
+
+def find_TNMR_backup_files(path_to_search, actions, log_std, threads=1,
+                           verify=False):
+    """Call each action as act(dirpath, fname) for each backup file found.
+
+    Actions with a finish() method (like BatchedRemove) have it called after
+    the search is complete."""
+    for dirpath, fname in iter_TNMR_backup_files(path_to_search, log_std,
+                                                 threads, verify):
+        for act in actions:
+            act(dirpath, fname)
+    for act in actions:
+        finish = getattr(act, 'finish', None)
+        if finish is not None:
+            finish()
 
 
 if __name__ == '__main__':
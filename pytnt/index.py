@@ -0,0 +1,324 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""A persistent index of the metadata in a collection of .tnt files
+
+The acquisition parameters of each file (sequence, nuclei, frequency,
+number of points, scans, start and finish times, user name and the names
+of the delay tables) are stored in an SQLite database, keyed by the path,
+size and modification time of the file. Updating the index only re-reads
+the files whose size or modification time has changed.
+
+Example:
+
+    >>> index = TNTIndex('archive.sqlite')
+    >>> index.update(['/data/nmr'])
+    >>> index.query(nucleus='7Li', min_freq=154, max_freq=156,
+    ...             start_after=datetime.datetime(2025, 3, 1))
+"""
+
+import argparse
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import os.path
+import sqlite3
+from time import gmtime
+
+from .processTNT import TNTfile
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT,
+    sequence TEXT,
+    nucleus TEXT,
+    nuclei TEXT,
+    ob_freq REAL,
+    npts0 INTEGER,
+    npts1 INTEGER,
+    npts2 INTEGER,
+    npts3 INTEGER,
+    scans INTEGER,
+    actual_scans INTEGER,
+    start_time INTEGER,
+    finish_time INTEGER,
+    username TEXT
+);
+CREATE TABLE IF NOT EXISTS delays (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS delays_path ON delays(path);
+CREATE INDEX IF NOT EXISTS files_start_time ON files(start_time);
+"""
+
+_FIELDS = ['path', 'size', 'mtime_ns', 'error', 'sequence', 'nucleus',
+           'nuclei', 'ob_freq', 'npts0', 'npts1', 'npts2', 'npts3', 'scans',
+           'actual_scans', 'start_time', 'finish_time', 'username']
+
+
+def _timestamp(value):
+    """Convert a datetime (as returned by TNTfile.start_time) to a Unix time"""
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.timetuple())
+    return value
+
+
+def _parse_date(text, end_of_day=False):
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            value = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if end_of_day and fmt == '%Y-%m-%d':
+            # The last second of the day, as the start times are whole seconds
+            value += datetime.timedelta(days=1, seconds=-1)
+        return value
+    raise argparse.ArgumentTypeError("Can't parse date '%s'" % text)
+
+
+def _parse_end_date(text):
+    """Parse a date for --before, which includes the whole of a bare date"""
+    return _parse_date(text, end_of_day=True)
+
+
+def _read_metadata(path, size, mtime_ns, encoding):
+    """Read the fields to be indexed from one file
+
+    Returns the row for the files table and a list of delay table names"""
+    row = dict.fromkeys(_FIELDS)
+    row.update(path=path, size=size, mtime_ns=mtime_ns)
+    try:
+        tnt = TNTfile(path, encoding=encoding, lazy=True)
+        nuclei = [tnt.decode(nucleus) for nucleus in tnt.nuclei]
+        row.update(
+            sequence=tnt.decode(tnt.sequence),
+            nucleus=nuclei[0],
+            nuclei=','.join(nuclei),
+            ob_freq=float(tnt.ob_freq[0]),
+            scans=int(tnt.scans),
+            actual_scans=int(tnt.actual_scans),
+            start_time=int(tnt.TMAG['start_time']),
+            finish_time=int(tnt.TMAG['finish_time']),
+            username=tnt.decode(tnt.username),
+        )
+        for dim, npts in enumerate(tnt.actual_npts):
+            row['npts%d' % dim] = int(npts)
+        delay_names = sorted(tnt.DELAY)
+    except Exception as err:
+        row['error'] = '%s: %s' % (type(err).__name__, err)
+        delay_names = []
+    return row, delay_names
+
+
+def _find_tnt_files(path):
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fname in filenames:
+                if fname.endswith('.tnt'):
+                    yield os.path.join(dirpath, fname)
+    else:
+        yield path
+
+
+class TNTIndex:
+
+    """An SQLite index of the metadata in .tnt files"""
+
+    def __init__(self, dbpath, encoding='ascii'):
+        """Open (or create) an index database.
+
+        Args:
+            dbpath: Path to the SQLite database file
+            encoding: Encoding to use when reading text data from the files
+        """
+        self.encoding = encoding
+        self.db = sqlite3.connect(dbpath)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, paths, workers=None, prune=True):
+        """Add new and changed files to the index.
+
+        Only files whose size or modification time differ from the values
+        stored in the index are read.
+
+        Args:
+            paths: Files and/or directories to index. Directories are
+                searched recursively for .tnt files.
+            workers: Number of threads used to read the changed files
+            prune: If True, remove files from the index which are no longer
+                present under the directories in paths
+
+        Returns:
+            A tuple of the number of files (re-)read, the number of unchanged
+            files and the number of files removed from the index
+        """
+        known = {row['path']: (row['size'], row['mtime_ns'])
+                 for row in self.db.execute('SELECT path, size, mtime_ns FROM files')}
+        seen = set()
+        changed = []
+        roots = []
+        for path in paths:
+            path = os.path.abspath(path)
+            if os.path.isdir(path):
+                roots.append(os.path.join(path, ''))
+            for fpath in _find_tnt_files(path):
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                seen.add(fpath)
+                if known.get(fpath) != (st.st_size, st.st_mtime_ns):
+                    changed.append((fpath, st.st_size, st.st_mtime_ns))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda args: _read_metadata(*args, encoding=self.encoding),
+                changed)
+            with self.db:
+                for row, delay_names in results:
+                    self.db.execute('DELETE FROM files WHERE path = ?', (row['path'],))
+                    self.db.execute(
+                        'INSERT INTO files (%s) VALUES (%s)' % (
+                            ', '.join(_FIELDS), ', '.join('?' * len(_FIELDS))),
+                        [row[field] for field in _FIELDS])
+                    self.db.executemany(
+                        'INSERT INTO delays (path, name) VALUES (?, ?)',
+                        [(row['path'], name) for name in delay_names])
+
+        removed = []
+        if prune:
+            removed = [path for path in known
+                       if path not in seen
+                       and any(path.startswith(root) for root in roots)]
+            with self.db:
+                self.db.executemany('DELETE FROM files WHERE path = ?',
+                                    [(path,) for path in removed])
+
+        return len(changed), len(seen) - len(changed), len(removed)
+
+    def query(self, sequence=None, nucleus=None, min_freq=None,
+              max_freq=None, start_after=None, start_before=None,
+              username=None, delay=None, include_errors=False):
+        """Find the files in the index which match all the given criteria.
+
+        Args:
+            sequence: Name of the pulse sequence (SQL LIKE pattern)
+            nucleus: The observed nucleus, e.g. '7Li' (SQL LIKE pattern)
+            min_freq, max_freq: Range of the observe frequency in MHz
+            start_after, start_before: Range of the acquisition start time,
+                as datetimes (no timezone) or Unix times
+            username: The user name stored in the file (SQL LIKE pattern)
+            delay: The name of a delay table which the file must contain
+            include_errors: If True, also return files which couldn't be read
+
+        Returns:
+            A list of dicts, one per file, sorted by start time
+        """
+        conditions = []
+        params = []
+        for column, pattern in [('sequence', sequence),
+                                ('nucleus', nucleus),
+                                ('username', username)]:
+            if pattern is not None:
+                conditions.append('%s LIKE ?' % column)
+                params.append(pattern)
+        for condition, value in [('ob_freq >= ?', min_freq),
+                                 ('ob_freq <= ?', max_freq),
+                                 ('start_time >= ?', _timestamp(start_after)),
+                                 ('start_time <= ?', _timestamp(start_before))]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if delay is not None:
+            conditions.append('path IN (SELECT path FROM delays WHERE name = ?)')
+            params.append(delay)
+        if not include_errors:
+            conditions.append('error IS NULL')
+
+        sql = 'SELECT * FROM files'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY start_time, path'
+
+        rows = [dict(row) for row in self.db.execute(sql, params)]
+        for row in rows:
+            row['delays'] = [r['name'] for r in self.db.execute(
+                'SELECT name FROM delays WHERE path = ? ORDER BY name',
+                (row['path'],))]
+        return rows
+
+
+## Command line interface
+
+parser = argparse.ArgumentParser(description='Index the metadata in .tnt files')
+parser.add_argument('database', help="Path to the SQLite index file")
+subparsers = parser.add_subparsers(dest='command')
+
+update_parser = subparsers.add_parser('update', help="Add new and changed files to the index")
+update_parser.add_argument('paths', nargs='+', help="Files or directories to index")
+update_parser.add_argument('--workers', '-j', type=int, default=None,
+                           help="Number of threads used to read files")
+update_parser.add_argument('--no-prune', action='store_false', dest='prune',
+                           help="Keep index entries for files which have been deleted")
+
+query_parser = subparsers.add_parser('query', help="Search the index")
+query_parser.add_argument('--sequence')
+query_parser.add_argument('--nucleus')
+query_parser.add_argument('--min-freq', type=float, help="Minimum frequency in MHz")
+query_parser.add_argument('--max-freq', type=float, help="Maximum frequency in MHz")
+query_parser.add_argument('--after', type=_parse_date,
+                          help="Only files started after this date (YYYY-MM-DD)")
+query_parser.add_argument('--before', type=_parse_end_date,
+                          help="Only files started on or before this date (YYYY-MM-DD)")
+query_parser.add_argument('--username')
+query_parser.add_argument('--delay', help="Name of a delay table, e.g. de7:2")
+query_parser.add_argument('--long', '-l', action='store_true',
+                          help="Print the main parameters as well as the path")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command (update or query) is required")
+
+    with TNTIndex(args.database) as index:
+        if args.command == 'update':
+            n_read, n_unchanged, n_removed = index.update(
+                args.paths, workers=args.workers, prune=args.prune)
+            print("%d files read, %d unchanged, %d removed" % (
+                n_read, n_unchanged, n_removed))
+        else:
+            rows = index.query(sequence=args.sequence, nucleus=args.nucleus,
+                               min_freq=args.min_freq, max_freq=args.max_freq,
+                               start_after=args.after, start_before=args.before,
+                               username=args.username, delay=args.delay)
+            for row in rows:
+                if args.long:
+                    start = datetime.datetime(*gmtime(row['start_time'])[:6])
+                    print('\t'.join([row['path'], row['sequence'], row['nucleus'],
+                                     '%.6f' % row['ob_freq'], start.isoformat(),
+                                     row['username']]))
+                else:
+                    print(row['path'])
+
+
+if __name__ == '__main__':
+    main()
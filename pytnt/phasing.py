@@ -0,0 +1,157 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Automatic phasing of many spectra at once
+
+Each spectrum gets its own zero order (and optionally first order) phase,
+but the spectra are all processed together with array operations, so
+there is no Python loop over the spectra.
+
+The zero order phase is chosen, as in TNTfile.LBfft, to maximise the
+integral of the real part of the spectrum. For a given first order phase
+this has a closed form. The first order phase is found by a grid search
+which minimises the sum of squares of the points of the real spectrum
+below the baseline, refined by parabolic interpolation between the grid
+points. The grid points are looped over, but each step works on all the
+spectra at once.
+
+The spectra are arrays with frequency along axis 0, and the phases are
+in radians with the same convention as the phase and ph1 arguments of
+TNTfile.LBfft.
+"""
+
+import numpy as np
+
+
+def _ramp(npts_ft, ndim):
+    """The first order phase ramp, shaped to broadcast against the spectra"""
+    ramp = np.linspace(-0.5, 0.5, npts_ft)
+    return ramp.reshape((npts_ft,) + (1,) * (ndim - 1))
+
+
+def phase_factor(npts_ft, ph0, ph1, dtype=complex, ndim=None):
+    """Return the factors which apply the phases ph0 and ph1 to spectra
+
+    Args:
+        npts_ft: Number of points in each spectrum
+        ph0, ph1: Zero and first order phases, either scalars or arrays of
+            the shape of the spectra without axis 0
+        dtype: Complex dtype of the factors
+        ndim: Number of dimensions of the spectra, by default one more
+            than ph0 and ph1
+
+    Returns:
+        An array with axis 0 of length npts_ft which can be multiplied by
+        the spectra
+    """
+    ph0 = np.asarray(ph0)
+    ph1 = np.asarray(ph1)
+    if ndim is None:
+        ndim = 1 + max(ph0.ndim, ph1.ndim)
+    return np.exp(1j * (ph0 + ph1 * _ramp(npts_ft, ndim))).astype(dtype)
+
+
+def zero_order(spectra, ph1=0):
+    """Find the zero order phase of each spectrum
+
+    Args:
+        spectra: Complex array of spectra, with frequency along axis 0
+        ph1: The first order phase that will be applied, a scalar or one
+            value per spectrum
+
+    Returns:
+        The phase maximising the integral of the real part of each
+        spectrum, as an array of shape spectra.shape[1:]
+    """
+    if np.all(np.asarray(ph1) == 0):
+        total = np.sum(spectra, axis=0)
+    else:
+        rotation = phase_factor(spectra.shape[0], 0, ph1, spectra.dtype, spectra.ndim)
+        total = np.sum(spectra * rotation, axis=0)
+    return -np.angle(total)
+
+
+# Number of points used to estimate the baseline of each spectrum
+BASELINE_POINTS = 256
+
+
+def _negative_penalties(spectra, grid, peak_fraction):
+    """For each first order phase in grid, the sum of squares of the points
+    of each real spectrum below its baseline, after phasing with that first
+    order phase and the best zero order phase.
+
+    Returns:
+        An array of shape (len(grid), number of spectra)
+    """
+    npts = spectra.shape[0]
+    rotations = np.exp(1j * np.outer(grid, _ramp(npts, 1))).astype(spectra.dtype)
+    # The integral of each spectrum for every first order phase, from which
+    # the zero order phases follow, in one matrix product
+    totals = rotations @ spectra
+
+    # Misphased peaks only go negative near the peaks, so the penalty only
+    # needs to be calculated for the largest points of each spectrum
+    n_peak = min(max(int(npts * peak_fraction), 1), npts)
+    peaks = np.argpartition(-abs(spectra), n_peak - 1, axis=0)[:n_peak]
+    peak_values = np.take_along_axis(spectra, peaks, axis=0)
+    # Most points are baseline, so the median of a sample of them is a good
+    # estimate of it
+    sample = slice(None, None, max(npts // BASELINE_POINTS, 1))
+    sample_values = spectra[sample]
+
+    penalties = np.empty((len(grid), spectra.shape[1]))
+    for i in range(len(grid)):
+        ph0 = -np.angle(totals[i])
+        cos_ph0, sin_ph0 = np.cos(ph0), np.sin(ph0)
+        rotated = peak_values * rotations[i][peaks]
+        real = rotated.real * cos_ph0 - rotated.imag * sin_ph0
+        rotated = sample_values * rotations[i][sample, np.newaxis]
+        real -= np.median(rotated.real * cos_ph0 - rotated.imag * sin_ph0, axis=0)
+        np.minimum(real, 0, out=real)
+        penalties[i] = np.sum(real * real, axis=0)
+    return penalties
+
+
+def first_order(spectra, ph1_range=(-np.pi, np.pi), ph1_steps=65,
+                peak_fraction=0.125):
+    """Find the zero and first order phases of each spectrum
+
+    When there is only one peak the first order phase is poorly defined,
+    but the phased spectrum is still close to absorption mode.
+
+    Args:
+        spectra: Complex array of spectra, with frequency along axis 0
+        ph1_range: Range of first order phases to search (in radians)
+        ph1_steps: Number of grid points in ph1_range
+        peak_fraction: Fraction of the points of each spectrum (the
+            largest ones) which are checked for negative values. The
+            baseline they are compared to is the median of an evenly
+            spaced sample of at least BASELINE_POINTS points of the whole
+            spectrum (or all of them, for shorter spectra).
+
+    Returns:
+        Tuple of arrays (ph0, ph1), each of shape spectra.shape[1:]
+    """
+    spectra = np.asarray(spectra)
+    shape = spectra.shape[1:]
+    flat = np.reshape(spectra, (spectra.shape[0], -1), order='F')
+    grid = np.linspace(ph1_range[0], ph1_range[1], ph1_steps)
+    penalty = _negative_penalties(flat, grid, peak_fraction)
+    best = np.argmin(penalty, axis=0)
+    ph1 = grid[best]
+
+    if ph1_steps >= 3:
+        # Fit a parabola through the best point and its neighbours
+        centre = np.clip(best, 1, ph1_steps - 2)
+        y0, y1, y2 = (np.take_along_axis(penalty, (centre + k)[np.newaxis], 0)[0]
+                      for k in (-1, 0, 1))
+        curvature = y0 - 2 * y1 + y2
+        interior = (centre == best) & (curvature > 0)
+        shift = 0.5 * (y0 - y2) / np.where(interior, curvature, 1)
+        step = grid[1] - grid[0]
+        ph1 = ph1 + np.where(interior, np.clip(shift, -1, 1), 0) * step
+
+    # A scalar like ph0 for a single spectrum, not a 0-d array
+    ph1 = np.reshape(ph1, shape, order='F')[()]
+    return zero_order(spectra, ph1), ph1
@@ -7,31 +7,173 @@
 """
 
 import sys
-import io
+import mmap
+import os
 from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
+from functools import lru_cache
+import time
 from time import gmtime
-import re
 import numpy as np
-from numpy.fft import fftfreq, fftshift
-import numpy.dual as npfast
-
-from . import TNTdtypes
-from .utils import convert_si, read_pascal_string
+from numpy.fft import fftshift
+
+from . import TNTdtypes, chirpz, fftbackend, phasing, profiling
+from .axes import Axis, _fid_times, _freq_Hz, _freq_ppm
+from .utils import CACHE_SIZE, _readonly, scan_delay_tables, unsqueeze
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _lbweight(npts, LBdw, real_dtype):
+    """Exponential line broadening weights, shaped to broadcast along axis 0"""
+    lbweight = np.exp(LBdw * np.arange(npts, dtype=float)).astype(real_dtype)
+    return _readonly(lbweight[:, np.newaxis, np.newaxis, np.newaxis])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _phase_factor(npts_ft, phase, ph1, dtype):
+    """Zero and first order phase correction, shaped to broadcast along axis 0"""
+    phase_factor = np.exp(1j * (phase + ph1 * np.linspace(-0.5, 0.5, npts_ft)))
+    return _readonly(phase_factor.astype(dtype)[:, np.newaxis, np.newaxis, np.newaxis])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _header_axes(TMAG_bytes):
+    """The Axis of each dimension for the values in a TMAG struct
+
+    This is keyed on the bytes of the struct, so the axes follow any
+    changes to the header but are only built once for each version."""
+    TMAG = np.frombuffer(TMAG_bytes, TNTdtypes.TMAG, count=1)[0]
+    return tuple(Axis(TMAG['actual_npts'][d], TMAG['dwell'][d], TMAG['ob_freq'][d],
+                      TMAG['ref_freq'] if d == 0 else 0.0, TMAG['sw'][d])
+                 for d in range(4))
+
+
+_caches = OrderedDict([('lbweight', _lbweight),
+                       ('phase_factor', _phase_factor),
+                       ('freq_Hz', _freq_Hz),
+                       ('freq_ppm', _freq_ppm),
+                       ('fid_times', _fid_times),
+                       ('axes', _header_axes),
+                       ('chirps', chirpz._chirps)])
+
+
+def cache_info():
+    """Return the hit/miss statistics of the caches used for processing
+
+    The result is a dict mapping the name of each cache to a
+    functools CacheInfo tuple of (hits, misses, maxsize, currsize)."""
+    info = OrderedDict((name, cache.cache_info())
+                       for name, cache in _caches.items())
+    info['fft_plans'] = fftbackend.plan_cache_info()
+    return info
+
+
+def cache_clear():
+    """Empty the caches used for processing"""
+    for cache in _caches.values():
+        cache.cache_clear()
+    fftbackend.plan_cache_clear()
+
+
+def _spectrum_blocks(shape, ncols):
+    """Split a 4-D array into blocks of at most ncols spectra
+
+    The blocks are rectangular, and split along the highest dimension that
+    is needed to keep within ncols. Yields tuples of slices."""
+    ncols = max(int(ncols), 1)
+    n1, n2, n3 = shape[1:]
+    everything = slice(None)
+    if ncols >= n1 * n2 * n3:
+        yield (everything,) * 4
+    elif ncols >= n1 * n2:
+        step = ncols // (n1 * n2)
+        for i3 in range(0, n3, step):
+            yield (everything, everything, everything, slice(i3, i3 + step))
+    elif ncols >= n1:
+        step = ncols // n1
+        for i3 in range(n3):
+            for i2 in range(0, n2, step):
+                yield (everything, everything, slice(i2, i2 + step), slice(i3, i3 + 1))
+    else:
+        for i3 in range(n3):
+            for i2 in range(n2):
+                for i1 in range(0, n1, ncols):
+                    yield (everything, slice(i1, i1 + ncols),
+                           slice(i2, i2 + 1), slice(i3, i3 + 1))
+
+
+def _copy_range(infile, outfile, offset, length, chunk_size):
+    """Copy length bytes from offset in infile to the current position in outfile"""
+    infile.seek(offset)
+    while length > 0:
+        chunk = infile.read(min(chunk_size, length))
+        if not chunk:
+            raise IOError("Unexpected end of file")
+        outfile.write(chunk)
+        length -= len(chunk)
+
+
+@contextmanager
+def _replace_when_done(filename):
+    """Open a temporary file next to filename for writing, and rename it to
+    filename only if the with block completes, so that a failed write never
+    leaves a partly written file behind"""
+    tmpname = '%s.%s.tmp' % (filename, os.urandom(4).hex())
+    outfile = open(tmpname, 'xb')
+    try:
+        with outfile:
+            yield outfile
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+def _checked_blocks(blocks, shape):
+    """Pass on the (index, block) pairs of an array with the given shape,
+    raising ValueError before any block that doesn't match its index"""
+    whole = np.broadcast_to(np.empty((), dtype='<c8'), shape)
+    for index, block in blocks:
+        if np.shape(block) != whole[index].shape:
+            raise ValueError("DATA block for %r has shape %s, but actual_npts "
+                             "is %s so it should be %s"
+                             % (index, np.shape(block), shape, whole[index].shape))
+        yield index, block
+
+
+def _check_autophase(phase, ph1, autophase):
+    if autophase not in ('global', 'spectrum'):
+        raise ValueError("autophase must be 'global' or 'spectrum', not %r"
+                         % (autophase,))
+    if ph1 is None and (phase is not None or autophase != 'spectrum'):
+        raise ValueError("ph1=None needs phase=None and autophase='spectrum'")
 
 
 class TNTfile:
 
-    def __init__(self, tntfilename, encoding='ascii'):
+    def __init__(self, tntfilename, encoding='ascii', lazy=False, copy=False):
         """Open and read a .tnt file.
 
         Args:
             tntfilename: Path to the file to read
             encoding: Encoding to use when reading text data from the file
+            lazy: If True, only the magic number and the section headers
+                (including TMAG and TMG2) are read when the file is opened.
+                The delay tables and the DATA array are read from the file
+                the first time they are accessed.
+            copy: If False (the default), DATA is a read-only memory map of
+                the file, so the pages are shared between all the processes
+                reading the file. If True, DATA is read into an ordinary
+                in-memory array which can be modified.
         """
 
+        self.filename = tntfilename
         self.encoding = encoding
-        self.tnt_sections = OrderedDict()
+        self.copy = copy
+        self._DATA = None
+        self._DELAY = None
+        self._mmap = None
 
         with open(tntfilename, 'rb') as tntfile:
 
@@ -41,78 +183,336 @@ class TNTfile:
             if not TNTdtypes.Magic_re.match(self.tntmagic):
                 raise ValueError("Invalid magic number (is '%s' really a TNMR file?): %s" % (tntfilename, self.tntmagic))
 
-            ##Read in the section headers
-            tnthdrbytes = tntfile.read(TNTdtypes.TLV.itemsize)
-            while(TNTdtypes.TLV.itemsize == len(tnthdrbytes)):
-                tntTLV = np.frombuffer(tnthdrbytes, TNTdtypes.TLV)[0]
-                data_length = tntTLV['length']
-                hdrdict = {'offset': tntfile.tell(),
-                           'length': data_length,
-                           'bool': bool(tntTLV['bool'])}
-                if data_length <= 4096:
-                    hdrdict['data'] = tntfile.read(data_length)
-                    assert(len(hdrdict['data']) == data_length)
+            self.tnt_sections = self._read_headers(tntfile)
+            self._file_id = self._stat_id(tntfile)
+
+            if not lazy:
+                self._DELAY = self._read_delay_tables(tntfile)
+
+        self.TMAG, self.TMG2 = self._parse_structs(self.tnt_sections)
+        if not lazy:
+            self._DATA = self._map_DATA()
+
+    def _read_headers(self, tntfile):
+        """Read the section headers, starting just after the magic number
+
+        The file is memory-mapped so all the headers are found in a single
+        pass without reading the large sections in between.
+
+        Returns an OrderedDict mapping the section tags to dicts with the
+        offset and length of each section, and its data if it is small."""
+        tnt_sections = OrderedDict()
+        TLV_size = TNTdtypes.TLV.itemsize
+        with profiling.stage('header parse', self.filename) as record:
+            with mmap.mmap(tntfile.fileno(), 0, access=mmap.ACCESS_READ) as tntmap:
+                file_size = len(tntmap)
+                pos = TNTdtypes.Magic.itemsize
+                while pos + TLV_size <= file_size:
+                    tntTLV = np.frombuffer(tntmap[pos:pos + TLV_size], TNTdtypes.TLV)[0]
+                    data_length = int(tntTLV['length'])
+                    pos += TLV_size
+                    hdrdict = {'offset': pos,
+                               'length': data_length,
+                               'bool': bool(tntTLV['bool'])}
+                    if data_length <= 4096:
+                        hdrdict['data'] = tntmap[pos:pos + data_length]
+                        if len(hdrdict['data']) != data_length:
+                            raise ValueError("Section %s is incomplete"
+                                             % self.decode(tntTLV['tag']))
+                        record['bytes_read'] += data_length
+                    tnt_sections[self.decode(tntTLV['tag'])] = hdrdict
+                    record['bytes_read'] += TLV_size
+                    pos += data_length
+        return tnt_sections
+
+    def section(self, tag):
+        """Return the contents of a section of the file without copying it
+
+        This works for any section, including large ones like PSEQ whose
+        data is not kept in tnt_sections.
+
+        Args:
+            tag: The tag of the section, e.g. 'PSEQ'
+
+        Returns:
+            A read-only memoryview of a memory map of the file, which is
+            created on the first call
+        """
+        header = self.tnt_sections[tag]
+        end = header['offset'] + header['length']
+        tntmap = getattr(self, '_mmap', None)
+        if tntmap is None or len(tntmap) < end:  # Or the file has grown
+            with open(self.filename, 'rb') as tntfile:
+                tntmap = mmap.mmap(tntfile.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmap = tntmap
+        if len(tntmap) < end:
+            raise ValueError("Section %s is incomplete" % tag)
+        return memoryview(tntmap)[header['offset']:end]
+
+    @staticmethod
+    def _stat_id(tntfile):
+        """The inode and modification time of an open file, which change if
+        the file is written or replaced"""
+        stat = os.fstat(tntfile.fileno())
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    @staticmethod
+    def _parse_structs(tnt_sections):
+        """Parse the TMAG and TMG2 structs from the section headers"""
+        # These are checked explicitly, not with assert, because refresh
+        # relies on them to detect a file that is being written
+        if tnt_sections['TMAG']['length'] != TNTdtypes.TMAG.itemsize:
+            raise ValueError("TMAG section has the wrong length")
+        # Use a bytearray so the parameters can be changed before writing
+        TMAG = np.frombuffer(bytearray(tnt_sections['TMAG']['data']),
+                             TNTdtypes.TMAG, count=1)[0]
+
+        if tnt_sections['DATA']['length'] != TMAG['actual_npts'].prod() * 8:
+            raise ValueError("DATA section length doesn't match actual_npts")
+
+        if tnt_sections['TMG2']['length'] != TNTdtypes.TMG2.itemsize:
+            raise ValueError("TMG2 section has the wrong length")
+        TMG2 = np.frombuffer(bytearray(tnt_sections['TMG2']['data']),
+                             TNTdtypes.TMG2, count=1)[0]
+        return TMAG, TMG2
+
+    def refresh(self):
+        """Re-read the headers of a file which is still being acquired.
+
+        The section headers, TMAG and TMG2 are read again, and DATA is
+        mapped again if the DATA section has grown. If the file is in the
+        middle of being written and can't be parsed, nothing is changed.
+
+        Returns:
+            A tuple (start, stop) such that self.DATA[:, start:stop] are the
+            spectra which have been completed since the previous refresh
+        """
+        n_before = self.n_complete_spec()
+        try:
+            with open(self.filename, 'rb') as tntfile:
+                tnt_sections = self._read_headers(tntfile)
+                file_size = os.fstat(tntfile.fileno()).st_size
+                file_id = self._stat_id(tntfile)
+            TMAG, TMG2 = self._parse_structs(tnt_sections)
+            DATA_end = tnt_sections['DATA']['offset'] + tnt_sections['DATA']['length']
+            if DATA_end > file_size:
+                raise ValueError("DATA section is incomplete")
+        except (KeyError, ValueError):
+            return (n_before, n_before)
+
+        old_DATA = self.tnt_sections['DATA']
+        new_DATA = tnt_sections['DATA']
+        if (self.copy or file_id != getattr(self, '_file_id', None) or
+                (new_DATA['offset'], new_DATA['length']) !=
+                (old_DATA['offset'], old_DATA['length'])):
+            # A copy is out of date as soon as the file changes, and a memory
+            # map still shows the old file if it has been replaced
+            self._DATA = None
+        self._file_id = file_id
+        if tnt_sections.get('PSEQ') != self.tnt_sections.get('PSEQ'):
+            self._DELAY = None
+        self.tnt_sections = tnt_sections
+        self.TMAG, self.TMG2 = TMAG, TMG2
+        self._mmap = None  # The file may have been replaced
+
+        return (n_before, max(self.n_complete_spec(), n_before))
+
+    def follow(self, poll_interval=1, timeout=None, start=0, idle_timeout=600):
+        """Generate the spectra of a file as they are acquired.
+
+        The file is checked for new complete spectra every poll_interval
+        seconds, until all the spectra in npts have been acquired, or until
+        the acquisition seems to have been stopped early.
+
+        Args:
+            poll_interval: Time to wait between checks (in s)
+            timeout: Stop if there are no new spectra for this many seconds
+            start: Index of the first spectrum to generate
+            idle_timeout: Stop if the file hasn't been written to for this
+                many seconds, e.g. because the acquisition was stopped
+                before all the spectra were acquired. This should be longer
+                than the time taken by one scan. None to wait for ever.
+
+        Yields:
+            Tuples (start, DATA) where DATA is the 4-D array of the new
+            spectra beginning at index start along dimension 1
+        """
+        n_done = start
+        last_new = last_change = time.monotonic()
+        file_id = getattr(self, '_file_id', None)
+        while True:
+            n_complete = self.refresh()[1]
+            now = time.monotonic()
+            if n_complete > n_done:
+                yield n_done, self.DATA[:, n_done:n_complete]
+                n_done = n_complete
+                last_new = now
+            if self._file_id != file_id:
+                file_id = self._file_id
+                last_change = now
+            if n_done >= self.npts[1]:
+                return
+            if timeout is not None and now - last_new > timeout:
+                return
+            if idle_timeout is not None and now - last_change > idle_timeout:
+                return
+            time.sleep(poll_interval)
+
+    def _read_delay_tables(self, tntfile):
+        """Find and parse the delay tables in the PSEQ section"""
+        # Start the search well past the data section so we scan as little
+        # of the file as possible
+        offset = self.tnt_sections["PSEQ"]["offset"]
+        with profiling.stage('delay scan', self.filename) as record:
+            DELAY = scan_delay_tables(tntfile, offset, encoding=self.encoding)
+            record['bytes_read'] = max(tntfile.tell() - offset, 0)
+        return DELAY
+
+    def _map_DATA(self):
+        """Map (or read, if self.copy is True) the DATA section as a 4-D array"""
+        offset = self.tnt_sections['DATA']['offset']
+        shape = tuple(self.TMAG['actual_npts'].tolist())
+        with profiling.stage('DATA mapping', self.filename) as record:
+            if self.copy:
+                with open(self.filename, 'rb') as tntfile:
+                    tntfile.seek(offset)
+                    DATA = np.fromfile(tntfile, np.dtype('<c8'), count=np.prod(shape))
+                record['bytes_read'] = DATA.nbytes
+                return np.reshape(DATA, shape, order='F')
+            return np.memmap(self.filename, np.dtype('<c8'), mode='r',
+                             offset=offset, shape=shape, order='F')
+
+    @property
+    def DATA(self):
+        """The NMR data as a 4-D array, mapped from the file on first access"""
+        if self._DATA is None:
+            self._DATA = self._map_DATA()
+        return self._DATA
+
+    @DATA.setter
+    def DATA(self, value):
+        self._DATA = value
+
+    @property
+    def DELAY(self):
+        """A dict of the delay tables in the pulse sequence, read from the
+        file on first access"""
+        if self._DELAY is None:
+            with open(self.filename, 'rb') as tntfile:
+                self._DELAY = self._read_delay_tables(tntfile)
+        return self._DELAY
+
+    @DELAY.setter
+    def DELAY(self, value):
+        self._DELAY = value
+
+    def __getstate__(self):
+        """Don't include the memory-mapped data when pickling
+
+        The data will be mapped again when it is accessed after unpickling,
+        so sending a TNTfile to another process doesn't copy the data."""
+        state = self.__dict__.copy()
+        if isinstance(self._DATA, np.memmap) and not self.copy:
+            state['_DATA'] = None
+        state['_mmap'] = None
+        return state
+
+    def writefile(self, outfilename, DATA=None, chunk_size=1 << 24):
+        """Write a .tnt file with the current TMAG and TMG2 parameters.
+
+        All the other sections are copied unchanged from the original file.
+
+        Args:
+            outfilename: Path of the file to write. This must not be the
+                original file; use write_inplace to change that.
+            DATA: The data to write instead of self.DATA. Either an array
+                (which is unsqueezed to 4-D, and its shape written to
+                actual_npts), or an iterable of (index, block) pairs covering
+                the whole of a 4-D array in Fortran order, as generated by
+                iter_LBfft, which must have the shape of self.DATA.
+            chunk_size: Size of the pieces in which large sections are
+                copied from the original file
+        """
+        if os.path.exists(outfilename) and os.path.samefile(outfilename, self.filename):
+            raise ValueError("Can't overwrite '%s' while reading from it, "
+                             "use write_inplace instead" % outfilename)
+
+        TMAG = self.TMAG.copy()
+        if DATA is None:
+            DATA = self.DATA
+        if isinstance(DATA, np.ndarray):
+            DATA = unsqueeze(DATA)
+            TMAG['actual_npts'] = DATA.shape
+            DATA = [((slice(None),) * 4, DATA)]
+        DATA = _checked_blocks(DATA, tuple(TMAG['actual_npts'].tolist()))
+
+        with open(self.filename, 'rb') as infile, _replace_when_done(outfilename) as outfile:
+            outfile.write(self.tntmagic.tobytes().ljust(TNTdtypes.Magic.itemsize, b'\0'))
+            for tag, hdrdict in self.tnt_sections.items():
+                if tag == 'TMAG':
+                    section = TMAG.tobytes()
+                elif tag == 'TMG2':
+                    section = self.TMG2.tobytes()
+                elif tag == 'DATA':
+                    section = None
+                    length = int(TMAG['actual_npts'].prod()) * 8
                 else:
-                    tntfile.seek(data_length, io.SEEK_CUR)
-                self.tnt_sections[self.decode(tntTLV['tag'])] = hdrdict
-                tnthdrbytes = tntfile.read(TNTdtypes.TLV.itemsize)
-            # Find and parse the delay tables
-            self.DELAY = {}
-            # This RegExp should match only bytearrays containing
-            # things like "deXX:X" or so.
-            delay_re = re.compile(b'de[0-9]+:[0-9]')
-            # seek well past the data section so we read as little
-            # of the file into memory as possible
-            tntfile.seek(self.tnt_sections["PSEQ"]["offset"])
-            search_region = tntfile.read()
-            # Do the search, and iterate over the matches
-            for match in delay_re.finditer(search_region):
-                # Lets go back and read the section properly. Offset back by
-                # four to capture the delay table name length
-                offset = (match.start() - 4)
-                # extract the name length, the name, the delay length,
-                # and the delay.
-                try:
-                    delay_name = read_pascal_string(search_region[offset:], encoding=self.encoding)
-                except IndexError:
-                    # Not a real delay table - the Pascal string was invalid
-                    continue
-                offset = match.start() + len(delay_name)
-                delay = read_pascal_string(search_region[offset:], encoding=self.encoding)
-                # Now check for delay tables of length one and discard them
-                if len(delay) > 1:
-                    delay = delay.split()
-                    delay = convert_si(delay)
-                    self.DELAY[delay_name] = delay
-
-        assert(self.tnt_sections['TMAG']['length'] == TNTdtypes.TMAG.itemsize)
-        self.TMAG = np.frombuffer(self.tnt_sections['TMAG']['data'],
-                                  TNTdtypes.TMAG, count=1)[0]
-
-        assert(self.tnt_sections['DATA']['length'] ==
-               self.TMAG['actual_npts'].prod() * 8)
-        ## For some reason we can't set offset and shape together
-        #DATA = np.memmap(tntfilename,np.dtype('<c8'), mode='r',
-        #                 offset=self.tnt_sections['DATA']['offset'],
-        #                 shape=self.TMAG['actual_npts'].tolist(),order='F')
-        self.DATA = np.memmap(tntfilename, np.dtype('<c8'), mode='c',
-                              offset=self.tnt_sections['DATA']['offset'],
-                              shape=self.TMAG['actual_npts'].prod())
-        self.DATA = np.reshape(self.DATA,
-                               self.TMAG['actual_npts'],
-                               order='F')
-
-        assert(self.tnt_sections['TMG2']['length'] == TNTdtypes.TMG2.itemsize)
-        self.TMG2 = np.frombuffer(self.tnt_sections['TMG2']['data'],
-                                  TNTdtypes.TMG2, count=1)[0]
-
-
-#    def writefile(self, outfilename):
-#        outfile = open(outfilename, 'wb')
-#        outfile.write(self.tntmagic)
-#        for tag in self.tnt_sections_order:
-#            tlv = np.asarray(self.tnt_sections[tag].items(), dtype=TNTdtypes.TLV)
-#
+                    section = hdrdict.get('data')
+                    length = hdrdict['length']
+                if section is not None:
+                    length = len(section)
+
+                tlv = np.array([(tag.encode(self.encoding), hdrdict['bool'], length)],
+                               dtype=TNTdtypes.TLV)
+                outfile.write(tlv.tobytes())
+                if tag == 'DATA':
+                    written = 0
+                    for index, block in DATA:
+                        block_bytes = np.asarray(block, dtype='<c8').tobytes(order='F')
+                        outfile.write(block_bytes)
+                        written += len(block_bytes)
+                    if written != length:
+                        raise ValueError("%d bytes of DATA were written but "
+                                         "actual_npts requires %d" % (written, length))
+                elif section is not None:
+                    outfile.write(section)
+                else:
+                    _copy_range(infile, outfile, hdrdict['offset'], length, chunk_size)
+
+    def write_inplace(self, DATA=None, TMG2=True):
+        """Write new data and/or processing parameters to the original file.
+
+        Only the bytes of the DATA and TMG2 sections are overwritten, so this
+        is fast even for very large files, but the shape of the data can't
+        be changed.
+
+        Args:
+            DATA: New data with the same shape as self.DATA, either as an
+                array or as an iterable of (index, block) pairs as generated
+                by iter_LBfft (with zf=0). If None, DATA is not changed.
+            TMG2: If True, write the current self.TMG2 to the file
+        """
+        if DATA is not None:
+            shape = tuple(self.TMAG['actual_npts'].tolist())
+            if isinstance(DATA, np.ndarray):
+                DATA = [((slice(None),) * 4, np.reshape(DATA, shape, order='A'))]
+            file_DATA = np.memmap(self.filename, np.dtype('<c8'), mode='r+',
+                                  offset=self.tnt_sections['DATA']['offset'],
+                                  shape=shape, order='F')
+            for index, block in _checked_blocks(DATA, shape):
+                file_DATA[index] = block
+            file_DATA.flush()
+            del file_DATA
+            if self.copy:
+                self._DATA = None  # Re-read the data on next access
+
+        if TMG2:
+            section = self.TMG2.tobytes()
+            assert len(section) == self.tnt_sections['TMG2']['length']
+            with open(self.filename, 'r+b') as tntfile:
+                tntfile.seek(self.tnt_sections['TMG2']['offset'])
+                tntfile.write(section)
+            self.tnt_sections['TMG2']['data'] = section
 
     @property
     def start_time(self):
@@ -135,15 +535,20 @@ class TNTfile:
         """The time when the file was saved
 
         No timezone information is available"""
-        strlen = self.TMAG['date'].index(b'\x00')
+        # numpy strips trailing NULs, so there may not be one left to find
+        bdate = self.TMAG['date'].split(b'\x00')[0]
         if sys.version_info.major <= 2:
-            datestr = str(self.TMAG['date'][:strlen])
+            datestr = str(bdate)
         else:
-            datestr = str(self.TMAG['date'][:strlen], encoding='ascii')
+            datestr = str(bdate, encoding='ascii')
         return datetime.datetime.strptime(datestr, "%Y/%m/%d %H:%M:%S")
 
     def __getattr__(self, name):
         """Expose members of the TMAG and TMG2 structures as attributes"""
+        if name.startswith('_') or name in ('TMAG', 'TMG2'):
+            # TMAG and TMG2 are not set yet (e.g. during unpickling), so
+            # looking them up here would recurse forever
+            raise AttributeError(name)
         if name in self.TMAG.dtype.names:
             return self.TMAG[name]
         elif name in self.TMG2.dtype.names:
@@ -151,8 +556,105 @@ class TNTfile:
         else:
             raise AttributeError("'%s' is not a member of the TMAG or TMG2 structs" % name)
 
+    def _DC_offset(self, DATA, DCoffset, dtype, logfile):
+        """The DC offset of the FIDs, broadcast to the shape of one point"""
+        if DCoffset is None:
+            # Taking the last eighth of the points seems to give OK (but not
+            # perfect) agreement with the TNMR DC offset correction.
+            # This hasn't been tested with enough different values of npts
+            # to be sure that this is the right formula.
+            with profiling.stage('DC offset', self.filename) as record:
+                DCtail = DATA[int(DATA.shape[0] / -8):, :, :, :]
+                DCoffset = np.mean(DCtail, axis=0, keepdims=True)
+                record['bytes_read'] = DCtail.nbytes
+            if logfile is not None:
+                logfile.write("average DC offset is %g\n" % np.mean(DCoffset))
+        return np.broadcast_to(np.asarray(DCoffset, dtype=dtype),
+                               (1,) + DATA.shape[1:])
+
+    def _global_phase_factor(self, DATA, DCoffset, dtype):
+        """The zero order phase correction which maximises the integral of
+        the real part of all the spectra together"""
+        # The sum over the whole spectrum is sqrt(npts_ft) times the sum
+        # of the first points of the FIDs, so the phase can be found
+        # before doing any FFTs.
+        with profiling.stage('phasing', self.filename):
+            phase_factor = np.exp(-1j * np.angle(np.sum(DATA[0] - DCoffset[0])))
+            return phase_factor.astype(dtype)
+
     def LBfft(self, LB=0, zf=0, phase=None, logfile=None, ph1=0,
-              DCoffset=None, altDATA=None):
+              DCoffset=None, altDATA=None, out=None, max_memory=None,
+              dtype=complex, fft_backend=None, workers=None,
+              autophase='global'):
+        """Apply line broadening, Fourier transform and phase the data.
+
+        Args:
+            LB: Exponential line broadening (in Hz)
+            zf: Zero fill the FIDs to npts * 2**zf points before the FFT
+            phase: Zero order phase (in radians), or None to phase
+                automatically
+            logfile: File to write progress messages to
+            ph1: First order phase (in radians). If phase is None, ph1 is
+                ignored unless autophase is 'spectrum'; then ph1=None finds
+                the first order phase of each spectrum too.
+            DCoffset: DC offset to subtract from the FIDs. By default it is
+                estimated from the last eighth of each FID
+            altDATA: Data to process instead of self.DATA
+            out: Array of shape (npts * 2**zf, ...) to write the spectra to,
+                e.g. a np.memmap for data which don't fit in memory
+            max_memory: If not None, process the spectra in blocks along
+                dimensions 1-3 so that the temporary arrays take up no more
+                than roughly this many bytes. The result is the same as
+                processing all the spectra at once.
+            dtype: The complex dtype to do the processing in. With
+                np.complex64 the apodisation, FFT and phasing are done in
+                single precision, which halves the memory use. The
+                difference from double precision is around 1e-6 of the
+                largest point in the spectrum, far below the noise level of
+                real data. (Plain numpy.fft before numpy 2.0 always uses
+                double precision internally, so the FFT step itself only
+                saves memory when a single precision FFT is available.)
+            fft_backend: The FFT implementation to use ('scipy', 'pyfftw'
+                or 'numpy'), see pytnt.fftbackend. Defaults to the one set
+                with fftbackend.set_backend.
+            workers: Number of threads to use for the FFT (-1 for all CPUs)
+            autophase: How to phase automatically when phase is None:
+                'global' to use the same phase for all the spectra, or
+                'spectrum' to phase each spectrum separately, see
+                pytnt.phasing
+
+        Returns:
+            The spectra as a 4-D complex array (out, if it was given)
+        """
+        blocks = self.iter_LBfft(LB, zf, phase, logfile, ph1, DCoffset,
+                                 altDATA, max_memory, dtype, fft_backend,
+                                 workers, autophase)
+        if out is None and max_memory is None:
+            ((index, DATAfft),) = blocks
+            return DATAfft
+
+        if out is None:
+            DATA = self.DATA if altDATA is None else altDATA
+            out = np.empty((DATA.shape[0] * 2 ** zf,) + DATA.shape[1:],
+                           dtype=dtype, order='F')
+        for index, DATAfft in blocks:
+            out[index] = DATAfft
+        return out
+
+    def iter_LBfft(self, LB=0, zf=0, phase=None, logfile=None, ph1=0,
+                   DCoffset=None, altDATA=None, max_memory=None,
+                   dtype=complex, fft_backend=None, workers=None,
+                   autophase='global'):
+        """Like LBfft, but generate the spectra one block at a time.
+
+        The arguments are the same as for LBfft. If max_memory is None all
+        the spectra are processed as a single block.
+
+        Yields:
+            Tuples of (index, block), where index is a tuple of slices such
+            that LBfft(...)[index] == block
+        """
+        _check_autophase(phase, ph1, autophase)
         if altDATA is None:
             DATA = self.DATA
         else:
@@ -160,73 +662,197 @@ class TNTfile:
         LBdw = -LB * self.dwell[0] * np.pi  # Multiply by pi to match TNMR
         npts = DATA.shape[0]
         npts_ft = npts * (2 ** zf)
+        dtype = np.dtype(dtype)
+        real_dtype = np.finfo(dtype).dtype
 
-        if DCoffset is None:
-            # Taking the last eighth of the points seems to give OK (but not
-            # perfect) agreement with the TNMR DC offset correction.
-            # This hasn't been tested with enough different values of npts
-            # to be sure that this is the right formula.
-            DCoffset = np.mean(DATA[int(npts / -8):, :, :, :],
-                               axis=0, keepdims=True)
-            if logfile is not None:
-                logfile.write("average DC offset is %g\n" % np.mean(DCoffset))
-
-        lbweight = np.exp(LBdw * np.arange(npts, dtype=float))
-        DATAlb = (DATA - DCoffset) * lbweight[:, np.newaxis, np.newaxis, np.newaxis]
+        DCoffset = self._DC_offset(DATA, DCoffset, dtype, logfile)
+        lbweight = _lbweight(npts, LBdw, real_dtype)
 
-        DATAfft = npfast.fft(DATAlb, n=npts_ft, axis=0)
-        DATAfft = fftshift(DATAfft, axes=[0])
-        DATAfft /= np.sqrt(npts_ft)  # To match TNMR behaviour
+        if phase is None and autophase == 'spectrum':
+            phase_factor = None  # Found for each block after the FFT
+        elif phase is None:  # Phase automatically
+            phase_factor = self._global_phase_factor(DATA, DCoffset, dtype)
+        else:
+            # Plain floats for the cache, as 0-d arrays are not hashable
+            phase_factor = _phase_factor(npts_ft, float(phase), float(ph1), dtype)
 
-        if phase is None:  # Phase automatically
-            DATAfft *= np.exp(-1j * np.angle(np.sum(DATAfft)))
+        if max_memory is None:
+            ncols = np.prod(DATA.shape[1:])
         else:
-            DATAfft *= np.exp(1j * (phase + ph1 * np.linspace(-0.5, 0.5, npts_ft))
-                              )[:, np.newaxis, np.newaxis, np.newaxis]
+            # Allow for the apodised FID, the FFT output and its shifted copy
+            ncols = max_memory // (npts_ft * dtype.itemsize * 3)
+            if phase_factor is None:
+                ncols //= 2  # Allow for the temporary arrays in phasing
+
+        for index in _spectrum_blocks(DATA.shape, ncols):
+            with profiling.stage('apodisation', self.filename) as record:
+                DATAblock = DATA[index]
+                record['bytes_read'] = DATAblock.nbytes
+                DATAlb = (DATAblock - DCoffset[index]) * lbweight
+
+            with profiling.stage('FFT', self.filename):
+                DATAfft = fftbackend.fft(DATAlb, n=npts_ft, axis=0,
+                                         backend=fft_backend, workers=workers)
+                DATAfft = DATAfft.astype(dtype, copy=False)
+                DATAfft = fftshift(DATAfft, axes=[0])
+                DATAfft /= np.sqrt(npts_ft)  # To match TNMR behaviour
+
+            with profiling.stage('phasing', self.filename):
+                if phase_factor is None:
+                    if ph1 is None:
+                        ph0, block_ph1 = phasing.first_order(DATAfft)
+                    else:
+                        ph0, block_ph1 = phasing.zero_order(DATAfft, ph1), ph1
+                    DATAfft *= phasing.phase_factor(npts_ft, ph0, block_ph1, dtype,
+                                                    DATAfft.ndim)
+                else:
+                    DATAfft *= phase_factor
 
-        return DATAfft
+            yield index, DATAfft
 
-    def freq_Hz(self, altDATA=None):
-        """Returns the frequency axis (in Hz) for the NMR spectrum"""
+    def LBzoom(self, max_ppm, min_ppm, npts_out=None, LB=0, zf=0, phase=None,
+               logfile=None, ph1=0, DCoffset=None, altDATA=None,
+               max_memory=None, dtype=complex, fft_backend=None, workers=None,
+               autophase='global'):
+        """Like LBfft, but only calculate the spectrum from max_ppm to min_ppm.
+
+        The points in the range are calculated directly with the chirp
+        z-transform (see pytnt.chirpz), so the time taken and the size of
+        the result hardly depend on zf. The spectrum is scaled and phased
+        the same as the npts * 2**zf point spectrum from LBfft.
+
+        Args:
+            max_ppm, min_ppm: The frequency range to calculate
+            npts_out: The number of points to calculate, evenly spaced from
+                max_ppm to min_ppm. By default the points are those of the
+                LBfft spectrum which are in the range, i.e. the result is
+                LBfft(...)[i_max:i_min] where (i_max, i_min) are the
+                ppm_points of the range in that spectrum.
+            autophase: As for LBfft, except that 'spectrum' phases each
+                spectrum using only the points in the range
+            The other arguments are the same as for LBfft.
+
+        Returns:
+            Tuple of (spectra, ppm) where spectra is a 4-D complex array
+            with the points in the range along axis 0, and ppm is their
+            frequencies
+        """
+        _check_autophase(phase, ph1, autophase)
         if altDATA is None:
-            npts = self.actual_npts[0]
+            DATA = self.DATA
+        else:
+            DATA = altDATA
+        LBdw = -LB * self.dwell[0] * np.pi  # Multiply by pi to match TNMR
+        npts = DATA.shape[0]
+        npts_ft = npts * (2 ** zf)
+        dtype = np.dtype(dtype)
+        real_dtype = np.finfo(dtype).dtype
+        axis = self.axes[0].with_npts(npts_ft)
+
+        # The positions of the points to calculate in the LBfft spectrum
+        if npts_out is None:
+            (i_max_ppm, i_min_ppm) = axis.ppm_points(max_ppm, min_ppm)
+            ppm = axis.ppm_at(np.arange(i_max_ppm, i_min_ppm))
+            npts_out = len(ppm)
+            first, step = float(i_max_ppm), 1.0
+        else:
+            ppm = np.linspace(max_ppm, min_ppm, npts_out)
+            first, last = npts_ft // 2 - ((np.array([max_ppm, min_ppm]) * axis.ob_freq
+                                           + axis.ref_freq) * npts_ft * axis.dwell)
+            step = (last - first) / max(npts_out - 1, 1)
+        positions = first + step * np.arange(npts_out)
+        # The first order phase ramp at those positions
+        ramp = positions / max(npts_ft - 1, 1) - 0.5
+        ramp = ramp[:, np.newaxis, np.newaxis, np.newaxis]
+
+        DCoffset = self._DC_offset(DATA, DCoffset, dtype, logfile)
+        lbweight = _lbweight(npts, LBdw, real_dtype)
+
+        if phase is None and autophase == 'spectrum':
+            phase_factor = None  # Found for each block after the transform
+        elif phase is None:
+            phase_factor = self._global_phase_factor(DATA, DCoffset, dtype)
+        else:
+            phase_factor = np.exp(1j * (phase + ph1 * ramp)).astype(dtype)
+
+        if max_memory is None:
+            ncols = np.prod(DATA.shape[1:])
         else:
-            npts = altDATA.shape[0]
-        dw = self.dwell[0]
-        ref_freq = self.ref_freq
+            # Allow for the apodised FID and the two FFTs in the transform
+            nfft = fftbackend.next_fast_len(npts + npts_out - 1)
+            ncols = max_memory // (nfft * dtype.itemsize * 3)
+            if phase_factor is None:
+                ncols //= 2  # Allow for the temporary arrays in phasing
+
+        out = np.empty((npts_out,) + DATA.shape[1:], dtype=dtype, order='F')
+        for index in _spectrum_blocks(DATA.shape, ncols):
+            with profiling.stage('apodisation', self.filename) as record:
+                DATAblock = DATA[index]
+                record['bytes_read'] = DATAblock.nbytes
+                DATAlb = (DATAblock - DCoffset[index]) * lbweight
+
+            with profiling.stage('FFT', self.filename):
+                # fftshift puts zero frequency at point npts_ft // 2
+                spectrum = chirpz.zoom_fft(DATAlb, npts_out, first - npts_ft // 2,
+                                           step, npts_ft, dtype,
+                                           fft_backend, workers)
+                spectrum /= np.sqrt(npts_ft)  # To match TNMR behaviour
+
+            with profiling.stage('phasing', self.filename):
+                if npts_out == 0:
+                    pass  # Nothing to phase
+                elif phase_factor is None and ph1 is None:
+                    ph0, block_ph1 = phasing.first_order(spectrum)
+                    spectrum *= phasing.phase_factor(npts_out, ph0, block_ph1, dtype,
+                                                     spectrum.ndim)
+                elif phase_factor is None:
+                    spectrum *= np.exp(1j * ph1 * ramp).astype(dtype)
+                    spectrum *= np.exp(1j * phasing.zero_order(spectrum)).astype(dtype)
+                else:
+                    spectrum *= phase_factor
+
+            out[index] = spectrum
+        return out, ppm
 
-        return -(fftshift(fftfreq(npts, dw)) + ref_freq)
+    @property
+    def axes(self):
+        """The time and frequency axes of the four dimensions, as a tuple
+        of pytnt.axes.Axis objects with actual_npts points
+
+        They are built from the current TMAG values, so they follow any
+        changes made to TMAG."""
+        return _header_axes(self.TMAG.tobytes())
+
+    def _axis(self, altDATA):
+        """The axis of dimension 0 of altDATA (or of DATA if it is None)"""
+        axis = self.axes[0]
+        if altDATA is None:
+            return axis
+        return axis.with_npts(altDATA.shape[0])
+
+    def freq_Hz(self, altDATA=None):
+        """Returns the frequency axis (in Hz) for the NMR spectrum
+
+        The array is cached, so it is read-only."""
+        return self._axis(altDATA).freq_Hz
 
     def freq_ppm(self, altDATA=None):
-        """Returns the frequency axis (in ppm) for the NMR spectrum"""
-        NMR_freq = self.ob_freq[0]
-        return self.freq_Hz(altDATA) / NMR_freq
+        """Returns the frequency axis (in ppm) for the NMR spectrum
+
+        The array is cached, so it is read-only."""
+        return self._axis(altDATA).freq_ppm
 
     def fid_times(self, altDATA=None):
-        """Returns the time axis (in s) for the FID"""
-        if altDATA is None:
-            npts = self.actual_npts[0]
-        else:
-            npts = altDATA.shape[0]
-        dw = self.dwell[0]
+        """Returns the time axis (in s) for the FID
 
-        return np.arange(npts) * dw
+        The array is cached, so it is read-only."""
+        return self._axis(altDATA).times
 
     def ppm_points(self, max_ppm, min_ppm, altDATA=None):
         """Given a maximum and minimum frequency (in ppm), return the indices
         of the points in the spectrum that correspond to the beginning and
         one-past-the-end of that range."""
-        ppm = self.freq_ppm(altDATA)
-        npts = len(ppm)
-
-        # Account for the situation in which max or min are out of range
-        i_max_ppm = 0
-        i_min_ppm = npts
-
-        # N.B. the ppm array goes from high to low
-        i_max_ppm = npts - np.searchsorted(ppm[::-1], max_ppm, side='right')
-        i_min_ppm = npts - np.searchsorted(ppm[::-1], min_ppm, side='left')
-        return (i_max_ppm, i_min_ppm)
+        return self._axis(altDATA).ppm_points(max_ppm, min_ppm)
 
     def ppm_points_reverse(self, min_ppm, max_ppm, altDATA=None):
         (i_max_ppm, i_min_ppm) = self.ppm_points(max_ppm, min_ppm, altDATA)
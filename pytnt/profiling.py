@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Optional timing of the stages of loading and processing .tnt files
+
+While a Profile is active, each stage (header parse, delay scan, DATA
+mapping, DC offset, apodisation, FFT, phasing and export) records its wall
+time, the number of bytes it read from the file and, if memory tracing is
+enabled, the peak memory allocated during the stage:
+
+    >>> with Profile(trace_memory=True) as prof:
+    ...     tnt = TNTfile('my-data-file.tnt')
+    ...     spectrum = tnt.LBfft(10, 1)
+    >>> prof.summary()['FFT']['wall_time']
+    0.0123
+    >>> prof.to_json()
+
+Stages run in any thread are recorded. When no Profile is active the
+overhead is negligible.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+import tracemalloc
+
+
+_active = []
+_lock = threading.Lock()
+
+
+class Profile:
+
+    """Collect timing records for the processing stages"""
+
+    def __init__(self, trace_memory=False, callback=None):
+        """
+        Args:
+            trace_memory: If True, use tracemalloc to record the peak memory
+                allocated in each stage. This slows things down a little.
+                (The peak is measured from the start of the most recently
+                started stage, so for nested stages it is only approximate.)
+            callback: A function called with each record (a dict) as soon as
+                its stage finishes
+        """
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.records = []
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        with _lock:
+            _active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            _active.remove(self)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _add(self, record):
+        with _lock:
+            self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """Total the records for each stage
+
+        Returns a dict mapping each stage name to a dict of the number of
+        calls, the total wall time and bytes read, and the largest peak
+        allocation."""
+        summary = OrderedDict()
+        for record in self.records:
+            totals = summary.setdefault(record['stage'], {
+                'calls': 0, 'wall_time': 0.0, 'bytes_read': 0, 'peak_alloc': None})
+            totals['calls'] += 1
+            totals['wall_time'] += record['wall_time']
+            totals['bytes_read'] += record['bytes_read']
+            if record['peak_alloc'] is not None:
+                totals['peak_alloc'] = max(totals['peak_alloc'] or 0,
+                                           record['peak_alloc'])
+        return summary
+
+    def as_dict(self):
+        return {'records': list(self.records), 'summary': self.summary()}
+
+    def to_json(self, **kwargs):
+        """Return the records and summary as a JSON string"""
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+@contextmanager
+def stage(name, filename=None, bytes_read=0):
+    """Time a processing stage if any Profile is active.
+
+    Yields a dict, in which the stage can update 'bytes_read' if it isn't
+    known in advance."""
+    record = {'stage': name, 'file': filename, 'bytes_read': bytes_read}
+    if not _active:
+        yield record
+        return
+
+    trace_memory = tracemalloc.is_tracing() and any(p.trace_memory for p in _active)
+    if trace_memory:
+        start_alloc = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_time'] = time.perf_counter() - start_time
+        record['bytes_read'] = int(record['bytes_read'])
+        record['peak_alloc'] = None
+        if trace_memory:
+            record['peak_alloc'] = max(tracemalloc.get_traced_memory()[1] - start_alloc, 0)
+        record['thread'] = threading.current_thread().name
+        for profile in list(_active):
+            profile._add(dict(record))
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2026 Christopher Kerr
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Generate synthetic .tnt files for testing and benchmarking
+
+The files have the same layout as those written by TNMR: the magic number,
+then TMAG, DATA, TMG2 and PSEQ sections, each preceded by a TLV header.
+The DATA section contains FIDs made of decaying complex exponentials plus
+Gaussian noise, and the PSEQ section contains the delay tables as Pascal
+strings surrounded by padding.
+"""
+
+import datetime
+from time import gmtime
+
+import numpy as np
+
+from . import TNTdtypes
+
+
+def _pascal_string(text, encoding='ascii'):
+    btext = text.encode(encoding)
+    return np.array(len(btext), dtype='<i4').tobytes() + btext
+
+
+def _tlv(tag, length):
+    return np.array([(tag, 1, length)], dtype=TNTdtypes.TLV).tobytes()
+
+
+def make_tnt_file(filename, actual_npts=(1024, 1, 1, 1), dwell=1e-5,
+                  ob_freq=100.0, ref_freq=0.0, peaks=((1000.0, 500.0, 1.0),),
+                  noise=0.01, scans=16, actual_scans=None, delay_tables=None,
+                  pseq_size=16384, sequence='onepulse', nucleus='1H',
+                  start_time=datetime.datetime(2020, 1, 1), seed=0,
+                  block_size=1 << 22):
+    """Write a synthetic .tnt file.
+
+    Args:
+        filename: Path of the file to write
+        actual_npts: The 4-D shape of the data
+        dwell: Dwell time in the direct dimension (in s)
+        ob_freq: Observe frequency (in MHz)
+        ref_freq: Reference frequency (in Hz)
+        peaks: Tuples of (frequency in Hz, linewidth in Hz, amplitude)
+        noise: Standard deviation of the noise added to the FIDs
+        scans: Number of scans per spectrum
+        actual_scans: Number of scans completed in the last spectrum
+            (defaults to scans)
+        delay_tables: A dict mapping delay table names (e.g. 'de7:2') to
+            lists of delays, either as numbers (in s) or as strings with
+            SI suffixes (e.g. '10m')
+        pseq_size: Number of bytes of padding in the PSEQ section
+        sequence: Name of the pulse sequence
+        nucleus: Observed nucleus
+        start_time: Acquisition start time (a datetime with no timezone)
+        seed: Seed for the random noise
+        block_size: Maximum number of points of DATA generated at once
+    """
+    actual_npts = tuple(int(n) for n in actual_npts)
+    npts = actual_npts[0]
+    nspec = int(np.prod(actual_npts[1:]))
+    if actual_scans is None:
+        actual_scans = scans
+    rng = np.random.RandomState(seed)
+
+    TMAG = np.zeros(1, dtype=TNTdtypes.TMAG)[0]
+    TMAG['npts'] = actual_npts
+    TMAG['actual_npts'] = actual_npts
+    TMAG['acq_points'] = npts
+    TMAG['scans'] = scans
+    TMAG['actual_scans'] = actual_scans
+    TMAG['ob_freq'][0] = ob_freq
+    TMAG['ref_freq'] = ref_freq
+    TMAG['dwell'] = [dwell, 1, 1, 1]
+    TMAG['sw'] = [1 / dwell, 1, 1, 1]
+    TMAG['acq_time'] = npts * dwell
+    TMAG['last_delay'] = 1.0
+    start = int((start_time - datetime.datetime(1970, 1, 1)).total_seconds())
+    elapsed = int(nspec * scans * (TMAG['acq_time'] + TMAG['last_delay']))
+    TMAG['start_time'] = start
+    TMAG['finish_time'] = start + elapsed
+    TMAG['elapsed_time'] = elapsed
+    date = datetime.datetime(*gmtime(start + elapsed)[:6])
+    TMAG['date'] = date.strftime("%Y/%m/%d %H:%M:%S").encode('ascii')
+    TMAG['nuclei'][0] = nucleus.encode('ascii')
+    TMAG['sequence'] = sequence.encode('ascii')
+
+    TMG2 = np.zeros(1, dtype=TNTdtypes.TMG2)[0]
+    TMG2['username'] = b'pytnt'
+
+    pseq = bytearray(pseq_size // 2)
+    for name, delays in (delay_tables or {}).items():
+        table = ' '.join(d if isinstance(d, str) else '%gs' % d for d in delays)
+        pseq += _pascal_string(name) + _pascal_string(table) + bytes(16)
+    pseq += bytearray(pseq_size - pseq_size // 2)
+
+    t = np.arange(npts) * dwell
+    fid = np.zeros(npts, dtype=complex)
+    for freq, linewidth, amplitude in peaks:
+        fid += amplitude * np.exp((2j * np.pi * freq - np.pi * linewidth) * t)
+
+    with open(filename, 'wb') as tntfile:
+        tntfile.write(b'TNT1.005')
+        tntfile.write(_tlv(b'TMAG', TNTdtypes.TMAG.itemsize))
+        tntfile.write(TMAG.tobytes())
+
+        tntfile.write(_tlv(b'DATA', npts * nspec * 8))
+        spec_per_block = max(block_size // npts, 1)
+        for i in range(0, nspec, spec_per_block):
+            j = min(i + spec_per_block, nspec)
+            # Vary the intensity along the indirect dimensions
+            scale = np.cos(np.pi * np.arange(i, j) / max(nspec, 2))
+            block = fid[:, np.newaxis] * scale
+            block += noise * (rng.standard_normal(block.shape) +
+                              1j * rng.standard_normal(block.shape))
+            tntfile.write(block.astype('<c8').tobytes(order='F'))
+
+        tntfile.write(_tlv(b'TMG2', TNTdtypes.TMG2.itemsize))
+        tntfile.write(TMG2.tobytes())
+
+        tntfile.write(_tlv(b'PSEQ', len(pseq)))
+        tntfile.write(bytes(pseq))
@@ -3,62 +3,117 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later AND BSD-3-Clause
 
+import io
+import itertools
+import re
+
 import numpy as np
 
-from . import TNTdtypes
+from . import TNTdtypes, profiling
+
+# This RegExp should match only bytearrays containing
+# things like "deXX:X" or so.
+delay_re = re.compile(b'de[0-9]+:[0-9]')
+
+# Number of each kind of processing vector or coordinate array to keep for reuse
+CACHE_SIZE = 32
 
 
 def unsqueeze(M, new_ndim=4):
     """Add extra dimensions to a matrix so it has the desired dimensionality"""
-    newshape = np.ones((new_ndim,))
+    newshape = np.ones((new_ndim,), dtype=int)
     newshape[:M.ndim] = M.shape
     return np.reshape(M, newshape, order='A')
 
 
+def _readonly(a):
+    a.flags.writeable = False
+    return a
+
+
+# A dict of all the SI prefixes
+SI_PREFIX = {'y': 1e-24,  # yocto
+             'z': 1e-21,  # zepto
+             'a': 1e-18,  # atto
+             'f': 1e-15,  # femto
+             'p': 1e-12,  # pico
+             'n': 1e-9,   # nano
+             'u': 1e-6,   # micro
+             'm': 1e-3,   # mili
+             'c': 1e-2,   # centi
+             'd': 1e-1,   # deci
+             's': 1,      # seconds
+             'k': 1e3,    # kilo
+             'M': 1e6,    # mega
+             'G': 1e9,    # giga
+             'T': 1e12,   # tera
+             'P': 1e15,   # peta
+             'E': 1e18,   # exa
+             'Z': 1e21,   # zetta
+             'Y': 1e24,   # yotta
+             }
+
+# The multiplier for each prefix, indexed by its character code, and 1 for
+# other characters
+_si_scale = np.ones(256)
+_si_scale[[ord(suffix) for suffix in SI_PREFIX]] = list(SI_PREFIX.values())
+_is_si_prefix = np.zeros(256, dtype=bool)
+_is_si_prefix[[ord(suffix) for suffix in SI_PREFIX]] = True
+
+
+def _convert_si_one(index, item):
+    try:
+        return float(item)
+    except ValueError:
+        # check if the last character is a valid prefix
+        if item[-1:] in SI_PREFIX:
+            try:
+                return SI_PREFIX[item[-1]] * float(item[:-1])
+            except ValueError:
+                pass
+    raise ValueError("Couldn't convert delay table entry %d (%r) to float! "
+                     "Make sure your suffixes correspond to real SI units."
+                     % (index, item))
+
+
 def convert_si(si_num_list):
     """takes a list of strings, si_num_lst, of the form xxx.xxx<si suffix>
     and returns an array of floats xxx.xxxe-6 or similar, depending on the si
     suffix
+
+    The suffixes of all the entries are found and stripped at once with
+    numpy, so the only per-entry work is the call to float(). Only if that
+    fails (e.g. for 'inf', which looks like it has an 'f' suffix) are the
+    entries converted one at a time, so that the index of an invalid entry
+    can be reported.
     """
-    # A dict of all the SI prefixes
-    prefix = {'y': 1e-24,  # yocto
-              'z': 1e-21,  # zepto
-              'a': 1e-18,  # atto
-              'f': 1e-15,  # femto
-              'p': 1e-12,  # pico
-              'n': 1e-9,   # nano
-              'u': 1e-6,   # micro
-              'm': 1e-3,   # mili
-              'c': 1e-2,   # centi
-              'd': 1e-1,   # deci
-              's': 1,      # seconds
-              'k': 1e3,    # kilo
-              'M': 1e6,    # mega
-              'G': 1e9,    # giga
-              'T': 1e12,   # tera
-              'P': 1e15,   # peta
-              'E': 1e18,   # exa
-              'Z': 1e21,   # zetta
-              'Y': 1e24,   # yotta
-              }
-    # go through the items in the list and try to float them. If they don't
-    # float...
-    for index, item in enumerate(si_num_list):
-        try:
-            si_num_list[index] = float(item)
-        except ValueError:
-            # check if the last character is a valid prefix
-            if item[-1] in prefix:
-                # if it is, set that list element to the rest of the item
-                # multiplied by the value appropriate to the prefix
-                si_num_list[index] = prefix[item[-1]] * float(item[:-1])
+    try:
+        return np.fromiter(map(float, si_num_list), float, len(si_num_list))
+    except ValueError:
+        pass  # Some of the entries have suffixes
+
+    try:
+        text = '\0'.join(si_num_list).encode('ascii')
+    except (TypeError, UnicodeEncodeError):
+        text = None
+    if text:
+        chars = np.frombuffer(text, dtype=np.uint8)
+        ends = np.append(np.flatnonzero(chars == 0), len(chars)) - 1
+        if len(ends) == len(si_num_list):  # No NULs within the entries
+            last_chars = chars[ends]
+            stripped = chars.copy()
+            # float() ignores the trailing space left in place of the prefix
+            stripped[ends[_is_si_prefix[last_chars]]] = ord(' ')
+            numbers = stripped.tobytes().decode('ascii').split('\0')
+            try:
+                values = np.fromiter(map(float, numbers), float, len(numbers))
+            except ValueError:
+                pass
             else:
-                # raise if it doesn't work out
-                raise ValueError("Couldn't convert delay table entires\
-                                 to float! Make sure your suffixes\
-                                 correspond to real SI units.")
-    #return it as an array
-    return np.array(si_num_list)
+                return values * _si_scale[last_chars]
+
+    return np.array([_convert_si_one(index, item)
+                     for index, item in enumerate(si_num_list)], dtype=float)
 
 
 def read_pascal_string(data, number_type='<i4', encoding='ascii'):
@@ -74,28 +129,125 @@ def read_pascal_string(data, number_type='<i4', encoding='ascii'):
     return text
 
 
-def save_gnuplot_matrix(tnt, mat_file, max_ppm=np.Inf, min_ppm=-np.Inf,
-                        altDATA=None, times=None, logfile=None):
+def read_pascal_string_at(fileobj, offset, file_size, number_type='<i4',
+                          encoding='ascii'):
+    """Read a Pascal string starting at a given offset in an open file
+
+    Returns the decoded string and the offset of the first byte after it.
+    Raises IndexError if the length prefix is not valid for a file of
+    size file_size."""
+    number_type = np.dtype(number_type)
+    number_size = number_type.itemsize
+    fileobj.seek(offset)
+    length_bytes = fileobj.read(number_size)
+    if len(length_bytes) < number_size:
+        raise IndexError("No room for a Pascal string at offset %d" % offset)
+    length = np.frombuffer(length_bytes, dtype=number_type, count=1).item()
+    end = offset + number_size + length
+    if length < 0 or end > file_size:
+        raise IndexError("Pascal string claims to have length %d but only "
+                         "%d bytes of data are available" % (
+                                 length, file_size - offset - number_size))
+    btext = fileobj.read(length)
+    return str(btext, encoding=encoding), end
+
+
+def scan_delay_tables(fileobj, offset=0, encoding='ascii',
+                      chunk_size=1 << 20, overlap=64):
+    """Find and parse the delay tables in an open .tnt file
+
+    The file is scanned from offset to the end in windows of chunk_size
+    bytes, so memory use does not depend on the size of the file. Each
+    window overlaps the previous one by overlap bytes so that table names
+    which straddle a window boundary are still found.
+
+    Returns a dict mapping the delay table names to arrays of delays."""
+    fileobj.seek(0, io.SEEK_END)
+    file_size = fileobj.tell()
+
+    DELAY = {}
+    window = b''
+    window_start = offset
+    read_pos = offset
+    while read_pos < file_size:
+        fileobj.seek(read_pos)
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        read_pos += len(chunk)
+        window += chunk
+        # Matches starting in the overlap will be found in the next window
+        if read_pos < file_size:
+            limit = max(len(window) - overlap, 0)
+        else:
+            limit = len(window)
+
+        for match in delay_re.finditer(window):
+            if match.start() >= limit:
+                break
+            # Offset back by four to capture the delay table name length
+            name_offset = window_start + match.start() - 4
+            if name_offset < offset:
+                continue
+            try:
+                delay_name, delay_offset = read_pascal_string_at(
+                    fileobj, name_offset, file_size, encoding=encoding)
+                delay, _ = read_pascal_string_at(
+                    fileobj, delay_offset, file_size, encoding=encoding)
+            except IndexError:
+                # Not a real delay table - the Pascal string was invalid
+                continue
+            # Now check for delay tables of length one and discard them
+            if len(delay) > 1:
+                DELAY[delay_name] = convert_si(delay.split())
+
+        window = window[limit:]
+        window_start += limit
+    return DELAY
+
+
+def save_gnuplot_matrix(tnt, mat_file, max_ppm=np.inf, min_ppm=-np.inf,
+                        altDATA=None, times=None, logfile=None, blocks=None,
+                        progress=None, block_size=256):
     """Save a file suitable for use as a gnuplot 'binary matrix'
 
     Only the real part is saved, and it is converted to 32 bit float.
     The frequency goes in the first row, and the acquisition time goes in
     the first column.
 
+    The spectra are copied block_size at a time. Instead of altDATA, the
+    spectra can be given as blocks, an iterable of (index, block) pairs as
+    generated by TNTfile.iter_LBfft, so that the whole array of spectra
+    never has to be in memory at once. If progress is given, it is called
+    as progress(n_done, nspec) after each block is written.
+
     See http://gnuplot.sourceforge.net/docs_4.2/node330.html for a
     description of the data format."""
+    if blocks is not None:
+        # Peek at the first block to find the size of the spectrum
+        blocks = iter(blocks)
+        first_block = next(blocks)
+        blocks = itertools.chain([first_block], blocks)
+        altDATA = first_block[1]
+
     ppm = tnt.freq_ppm(altDATA)
     (i_max_ppm, i_min_ppm) = tnt.ppm_points(max_ppm, min_ppm, altDATA)
 
     ppm = ppm[i_max_ppm:i_min_ppm]
-    if altDATA is None:
-        DATAslice = tnt.DATA[i_max_ppm:i_min_ppm, :]
-        nspec = tnt.n_complete_spec()
+    npts = len(ppm)
+    if blocks is not None:
+        nspec = tnt.n_complete_spec() if times is None else len(times)
+        column_blocks = _column_blocks_from_LBfft(blocks, i_max_ppm,
+                                                  i_min_ppm, nspec)
     else:
-        DATAslice = altDATA[i_max_ppm:i_min_ppm, :]
-        nspec = altDATA.shape[1]
-
-    npts = DATAslice.shape[0]
+        if altDATA is None:
+            DATAslice = tnt.DATA[i_max_ppm:i_min_ppm, :]
+            nspec = tnt.n_complete_spec()
+        else:
+            DATAslice = altDATA[i_max_ppm:i_min_ppm, :]
+            nspec = altDATA.shape[1]
+        column_blocks = ((i, DATAslice.real[:, i:min(i + block_size, nspec)])
+                         for i in range(0, nspec, block_size))
 
     gpt_matrix = np.memmap(mat_file, dtype='f4', mode='w+',
                            shape=(npts + 1, nspec + 1), order='F')
@@ -105,12 +257,14 @@ def save_gnuplot_matrix(tnt, mat_file, max_ppm=np.Inf, min_ppm=-np.Inf,
 
     if times is None:
         times = tnt.spec_times(nspec)
+    gpt_matrix[0, 1:] = times[:nspec]
 
-    for i in range(nspec):
-        gpt_matrix[0, i+1] = times[i]
-        ## without the 'squeeze', we get some kind of 'output operand
-        ## requires a reduction, but reduction is not enabled' error ??
-        gpt_matrix[1:, i+1] = DATAslice.real[:, i].squeeze()
+    for i, columns in column_blocks:
+        ncols = columns.shape[1]
+        with profiling.stage('export', tnt.filename):
+            gpt_matrix[1:, i + 1:i + ncols + 1] = np.reshape(columns, (npts, ncols))
+        if progress is not None:
+            progress(i + ncols, nspec)
         if logfile is not None:
             logfile.write('.')
             logfile.flush()
@@ -121,6 +275,16 @@ def save_gnuplot_matrix(tnt, mat_file, max_ppm=np.Inf, min_ppm=-np.Inf,
     del(gpt_matrix)  # flush the file to disk
 
 
+def _column_blocks_from_LBfft(blocks, i_max_ppm, i_min_ppm, nspec):
+    """Convert the output of TNTfile.iter_LBfft to blocks of real columns"""
+    for index, block in blocks:
+        assert block.ndim == 2 or block.shape[2:] == (1, 1)  # 2D data only
+        start = index[1].start or 0
+        ncols = min(block.shape[1], nspec - start)
+        if ncols > 0:
+            yield start, block.real[i_max_ppm:i_min_ppm, :ncols]
+
+
 def dump_params_txt(tnt, txtfile):
     """Write a text file with the acquisition and processing parameters"""
     if type(txtfile) == str:
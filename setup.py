@@ -34,9 +34,17 @@ setup(
     entry_points={
         'console_scripts': [
             'find_TNMR_backup_files = pytnt.find_TNMR_backup_files:main',
+            'pytnt_index = pytnt.index:main',
+            'pytnt_convert = pytnt.export:main',
         ],
     },
     python_requires='>=3.6',
     install_requires=['numpy'],
+    extras_require={
+        'scipy': ['scipy'],
+        'fftw': ['pyfftw'],
+        'hdf5': ['h5py'],
+        'zarr': ['zarr'],
+    },
     tests_require=['pytest'],
 )
@@ -7,13 +7,27 @@ The tests use the unittest library.
 """
 
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 import datetime
+import io
+import json
+import os.path
+import tempfile
 
 import numpy as np
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
 from numpy.testing import assert_array_almost_equal
 
-from pytnt.processTNT import TNTfile
+from pytnt import analysis, fftbackend, phasing, profiling
+from pytnt.export import to_hdf5
+from pytnt.find_TNMR_backup_files import BatchedRemove, find_TNMR_backup_files, _walk
+from pytnt.batch import iter_files, load_many
+from pytnt.index import TNTIndex, main as index_main
+from pytnt.processTNT import TNTfile, cache_info
+from pytnt.synthetic import make_tnt_file
+from pytnt.utils import save_gnuplot_matrix
+from pytnt.utils import convert_si, scan_delay_tables
 
 
 class TestLoadFile(unittest.TestCase):
@@ -41,6 +55,26 @@ class TestLoadFile(unittest.TestCase):
         assert_array_almost_equal(ref1.DATA.imag.squeeze(), imag, decimal=3)
         assert_array_almost_equal(ref1.freq_Hz(), hz, decimal=3)
 
+    def test_load_lazy(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+        lazy = TNTfile("testdata/LiCl_ref1.tnt", lazy=True)
+
+        self.assertEqual(lazy.sequence, ref1.sequence)
+        self.assertEqual(lazy.start_time, ref1.start_time)
+        self.assertIsNone(lazy._DATA)
+        self.assertIsNone(lazy._DELAY)
+        assert_array_almost_equal(lazy.DATA, ref1.DATA)
+        self.assertEqual(lazy.DELAY.keys(), ref1.DELAY.keys())
+
+    def test_load_copy(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+        copied = TNTfile("testdata/LiCl_ref1.tnt", copy=True)
+
+        self.assertFalse(ref1.DATA.flags.writeable)
+        self.assertTrue(copied.DATA.flags.writeable)
+        self.assertEqual(copied.DATA.shape, tuple(ref1.actual_npts))
+        assert_array_almost_equal(copied.DATA, ref1.DATA)
+
     def test_load_fails(self):
         with self.assertRaises(ValueError):
             zero = TNTfile("/dev/zero")
@@ -58,6 +92,512 @@ class TestLoadFile(unittest.TestCase):
         self.assertGreaterEqual(ref1.date, ref1.finish_time)
 
 
+class TestWriteFile(unittest.TestCase):
+
+    def test_round_trip(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfilename = os.path.join(tmpdir, 'copy.tnt')
+            ref1.writefile(outfilename)
+            with open("testdata/LiCl_ref1.tnt", 'rb') as f1, open(outfilename, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_write_inplace(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'nut2d.tnt')
+            TNTfile("testdata/nut2d.tnt").writefile(filename)
+            nut2d = TNTfile(filename)
+            my_ft = nut2d.LBfft(10)
+
+            nut2d.TMG2['linebrd'][0] = 10
+            nut2d.write_inplace(nut2d.iter_LBfft(10, max_memory=1))
+
+            processed = TNTfile(filename)
+            self.assertEqual(processed.linebrd[0], 10)
+            assert_allclose(processed.DATA, my_ft, rtol=1e-5, atol=1e-5)
+
+    def test_refresh(self):
+        nut2d = TNTfile("testdata/nut2d.tnt")
+        nspec = nut2d.actual_npts[1]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'nut2d.tnt')
+            # Pretend the last spectrum is still being acquired
+            nut2d.TMAG['actual_scans'] = nut2d.scans - 1
+            nut2d.writefile(filename)
+            acquiring = TNTfile(filename)
+            self.assertEqual(acquiring.n_complete_spec(), nspec - 1)
+            self.assertEqual(acquiring.refresh(), (nspec - 1, nspec - 1))
+
+            nut2d.TMAG['actual_scans'] = nut2d.scans
+            nut2d.writefile(filename + '.new')
+            os.replace(filename + '.new', filename)
+            self.assertEqual(acquiring.refresh(), (nspec - 1, nspec))
+            assert_allclose(acquiring.DATA[:, nspec - 1], nut2d.DATA[:, nspec - 1])
+
+
+class TestRefresh(unittest.TestCase):
+
+    """Tests refreshing a file which is changed while it is open"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'acquiring.tnt')
+        make_tnt_file(self.filename, actual_npts=(64, 4, 1, 1), scans=4, actual_scans=3)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_content_changed(self):
+        acquiring = TNTfile(self.filename, copy=True)
+        self.assertEqual(acquiring.refresh(), (3, 3))
+
+        # Finish the last spectrum by writing to the file in place
+        finished = TNTfile(self.filename)
+        new_DATA = np.array(finished.DATA)
+        new_DATA[:, 3] *= 4 / 3
+        finished.write_inplace(new_DATA)
+        TMAG = finished.TMAG.copy()
+        TMAG['actual_scans'] = 4
+        with open(self.filename, 'r+b') as tntfile:
+            tntfile.seek(finished.tnt_sections['TMAG']['offset'])
+            tntfile.write(TMAG.tobytes())
+
+        self.assertEqual(acquiring.refresh(), (3, 4))
+        assert_array_equal(acquiring.DATA, new_DATA)
+
+    def test_replaced(self):
+        acquiring = TNTfile(self.filename)
+        old = TNTfile(self.filename, copy=True)
+        old.writefile(self.filename + '.new', DATA=old.DATA * 2)
+        os.replace(self.filename + '.new', self.filename)
+        acquiring.refresh()
+        assert_array_equal(acquiring.DATA, old.DATA * 2)
+
+    def test_follow_stopped(self):
+        tnt = TNTfile(self.filename)
+        tnt.TMAG['npts'][1] = 10  # The acquisition stops after 3 spectra
+        tnt.writefile(self.filename + '.new')
+        os.replace(self.filename + '.new', self.filename)
+        following = TNTfile(self.filename)
+        blocks = list(following.follow(poll_interval=0.01, idle_timeout=0.1))
+        self.assertEqual([start for start, DATA in blocks], [0])
+        self.assertEqual(blocks[0][1].shape[1], 3)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    """Tests that synthetic files can be generated and loaded"""
+
+    def test_make_tnt_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            make_tnt_file(filename, actual_npts=(256, 5, 2, 1),
+                          peaks=[(2000.0, 100.0, 1.0)], noise=0,
+                          delay_tables={'de7:2': [1, 2, 3], 'de8:1': ['10m', '20u']},
+                          sequence='t1ir', start_time=datetime.datetime(2021, 3, 4))
+            tnt = TNTfile(filename)
+
+            self.assertEqual(tnt.DATA.shape, (256, 5, 2, 1))
+            self.assertEqual(tnt.sequence, b't1ir')
+            self.assertEqual(tnt.start_time, datetime.datetime(2021, 3, 4))
+            self.assertEqual(tnt.date, tnt.finish_time)
+            assert_allclose(tnt.DELAY['de7:2'], [1, 2, 3])
+            assert_allclose(tnt.DELAY['de8:1'], [10e-3, 20e-6])
+
+            spectrum = abs(tnt.LBfft()[:, 0, 0, 0])
+            peak_Hz = tnt.freq_Hz()[np.argmax(spectrum)]
+            self.assertAlmostEqual(peak_Hz, -2000.0, delta=1 / (256 * tnt.dwell[0]))
+
+    def test_section(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            make_tnt_file(filename, actual_npts=(256, 4, 1, 1), pseq_size=8192,
+                          delay_tables={'de7:2': [1, 2, 3]})
+            tnt = TNTfile(filename)
+            with open(filename, 'rb') as f:
+                contents = f.read()
+
+            for tag, header in tnt.tnt_sections.items():
+                section = tnt.section(tag)
+                self.assertTrue(section.readonly)
+                self.assertEqual(section, contents[header['offset']:
+                                                   header['offset'] + header['length']])
+            self.assertEqual(tnt.section('TMAG'), tnt.tnt_sections['TMAG']['data'])
+            self.assertIn(b'de7:2', bytes(tnt.section('PSEQ')))
+            self.assertEqual(np.frombuffer(tnt.section('DATA'), '<c8')[:256].tolist(),
+                             tnt.DATA[:, 0, 0, 0].tolist())
+            del section
+
+    def test_write_wrong_shape(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            outfilename = os.path.join(tmpdir, 'processed.tnt')
+            make_tnt_file(filename, actual_npts=(64, 4, 1, 1))
+            tnt = TNTfile(filename)
+            tnt.writefile(outfilename)
+            with open(outfilename, 'rb') as f:
+                contents = f.read()
+
+            blocks = [((slice(None), slice(0, 2)), np.ones((64, 2, 1, 1))),
+                      ((slice(None), slice(2, 4)), np.ones((64, 1, 1, 1)))]
+            with self.assertRaises(ValueError):
+                tnt.writefile(outfilename, blocks)
+            with open(outfilename, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['processed.tnt', 'synthetic.tnt'])
+
+            processed = TNTfile(outfilename)
+            with self.assertRaises(ValueError):
+                processed.write_inplace(blocks[1:])
+            with open(outfilename, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+
+
+class SyntheticFileTestCase(unittest.TestCase):
+
+    """Base class for tests which load synthetic files"""
+
+    def make_tnt(self, **kwargs):
+        """Make a file with make_tnt_file(**kwargs), which is deleted after
+        the test, and load it"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        filename = os.path.join(tmpdir.name, 'synthetic.tnt')
+        make_tnt_file(filename, **kwargs)
+        return TNTfile(filename)
+
+
+class TestPhasing(SyntheticFileTestCase):
+
+    """Tests the automatic phasing of each spectrum"""
+
+    def setUp(self):
+        self.tnt = self.make_tnt(actual_npts=(512, 20, 1, 1), noise=0.001,
+                                 peaks=[(3000.0, 300.0, 1.0), (-10000.0, 300.0, 0.5),
+                                        (20000.0, 200.0, 0.3)])
+        # Drop the spectra where the synthetic intensity is close to zero
+        self.ref = self.tnt.LBfft(0, 1, autophase='spectrum')[:, [0, 1, 2, 3, 4, 15, 16, 17]]
+        rng = np.random.RandomState(0)
+        self.ph0 = rng.uniform(-3, 3, (8, 1, 1))
+        self.ph1 = rng.uniform(-2, 2, (8, 1, 1))
+
+    def test_zero_order(self):
+        DATA = self.tnt.DATA[:, [0, 1, 2, 3, 4, 15, 16, 17]] * np.exp(-1j * self.ph0)
+        spectra = self.tnt.LBfft(0, 1, altDATA=DATA, autophase='spectrum')
+        assert_allclose(spectra, self.ref, atol=1e-6 * abs(self.ref).max())
+
+        spectra = self.tnt.LBfft(0, 1, altDATA=DATA)  # The same phase for all
+        self.assertGreater(abs(spectra - self.ref).max(), 0.1 * abs(self.ref).max())
+
+    def test_first_order(self):
+        npts_ft = self.ref.shape[0]
+        dephased = self.ref * phasing.phase_factor(npts_ft, -self.ph0, -self.ph1)
+        ph0, ph1 = phasing.first_order(dephased)
+        assert_allclose(ph1, self.ph1, atol=0.3)
+        rephased = dephased * phasing.phase_factor(npts_ft, ph0, ph1)
+        assert_allclose(rephased.real, self.ref.real, atol=0.05 * abs(self.ref).max())
+
+    def test_phases_passed_back(self):
+        spectrum = self.tnt.LBfft(5, 1, phase=0, ph1=0)[:, 0, 0, 0]
+        ph0, ph1 = phasing.first_order(spectrum)
+        self.assertIs(type(ph1), type(ph0))
+        phased = self.tnt.LBfft(5, 1, phase=ph0, ph1=ph1)
+        assert_allclose(phased, self.tnt.LBfft(5, 1, phase=float(ph0), ph1=float(ph1)))
+        assert_allclose(self.tnt.LBfft(phase=np.array(0.3)), self.tnt.LBfft(phase=0.3))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.tnt.LBfft(autophase='everything')
+        with self.assertRaises(ValueError):
+            self.tnt.LBfft(ph1=None)
+
+
+class TestZoom(SyntheticFileTestCase):
+
+    """Tests calculating part of the spectrum with LBzoom"""
+
+    def setUp(self):
+        self.tnt = self.make_tnt(actual_npts=(256, 6, 1, 1), noise=0.01,
+                                 peaks=[(3000.0, 300.0, 1.0), (-10000.0, 300.0, 0.5)])
+
+    def test_zoom(self):
+        full = self.tnt.LBfft(10, 3, phase=0.3, ph1=0.5)
+        ppm = self.tnt.freq_ppm(full)
+        (i_max, i_min) = self.tnt.ppm_points(20, -20, full)
+        spectra, zoom_ppm = self.tnt.LBzoom(20, -20, None, 10, 3, phase=0.3, ph1=0.5)
+        assert_array_equal(zoom_ppm, ppm[i_max:i_min])
+        assert_allclose(spectra, full[i_max:i_min], atol=1e-10 * abs(full).max())
+
+        spectra, zoom_ppm = self.tnt.LBzoom(ppm[i_max], ppm[i_min - 1], i_min - i_max,
+                                            10, 3, max_memory=1 << 14)
+        full = self.tnt.LBfft(10, 3)
+        assert_allclose(zoom_ppm, ppm[i_max:i_min])
+        assert_allclose(spectra, full[i_max:i_min], atol=1e-10 * abs(full).max())
+
+    def test_zoom_empty(self):
+        for kwargs in [{}, {'phase': 0.3, 'ph1': 0.5}, {'autophase': 'spectrum'},
+                       {'ph1': None, 'autophase': 'spectrum'}]:
+            spectra, zoom_ppm = self.tnt.LBzoom(2000, 1500, None, 5, 2, **kwargs)
+            self.assertEqual(spectra.shape, (0, 6, 1, 1))
+            self.assertEqual(len(zoom_ppm), 0)
+
+
+class TestAnalysis(SyntheticFileTestCase):
+
+    """Tests the region integration and peak picking"""
+
+    def setUp(self):
+        self.tnt = self.make_tnt(actual_npts=(256, 6, 2, 1), noise=0.01,
+                                 peaks=[(3000.0, 300.0, 1.0), (-10000.0, 300.0, 0.5)])
+        self.spectra = self.tnt.LBfft(10, 1, phase=0.3)
+        self.ppm = self.tnt.freq_ppm(self.spectra)
+        self.regions = [(120, 80), (0, -60), (10, 10)]
+
+    def test_analyse_regions(self):
+        results = analysis.analyse_regions(self.spectra, self.ppm, self.regions)
+        self.assertEqual(results.integrals.shape, (3, 12))
+        flat = np.reshape(self.spectra, (self.spectra.shape[0], -1), order='F')
+        for region, (max_ppm, min_ppm) in enumerate(self.regions):
+            (i_max, i_min) = self.tnt.ppm_points(max_ppm, min_ppm, self.spectra)
+            assert_allclose(results.integrals[region],
+                            np.sum(flat[i_max:i_min], axis=0))
+            if i_max == i_min:
+                self.assertTrue(np.isnan(results.heights[region]).all())
+                continue
+            peaks = i_max + np.argmax(flat[i_max:i_min].real, axis=0)
+            heights = flat[peaks, np.arange(12)].real
+            self.assertTrue((results.heights[region] >= heights).all())
+            assert_allclose(results.heights[region], heights,
+                            atol=0.05 * abs(self.spectra).max())
+            assert_allclose(results.positions[region], self.ppm[peaks],
+                            atol=abs(self.ppm[1] - self.ppm[0]))
+
+        blocks = self.tnt.iter_LBfft(10, 1, phase=0.3, max_memory=1 << 14)
+        chunked = analysis.analyse_regions(blocks, self.ppm, self.regions)
+        for values, chunked_values in zip(results, chunked):
+            assert_allclose(chunked_values, values)
+        assert_allclose(analysis.integrate_regions(self.spectra, self.ppm, self.regions),
+                        results.integrals)
+
+    def test_no_regions(self):
+        for ppm in (self.ppm, self.tnt.axes[0].zero_filled(1)):
+            results = analysis.analyse_regions(self.spectra, ppm, [])
+            self.assertEqual([values.shape for values in results], [(0, 12)] * 3)
+            self.assertEqual(analysis.integrate_regions(self.spectra, ppm, []).shape, (0, 12))
+
+
+class TestAxes(unittest.TestCase):
+
+    """Tests the coordinates and index lookups of the axes"""
+
+    def test_axes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            make_tnt_file(filename, actual_npts=(256, 6, 1, 1))
+            tnt = TNTfile(filename)
+        self.assertEqual([axis.npts for axis in tnt.axes], [256, 6, 1, 1])
+        self.assertIs(tnt.axes[0].freq_ppm, tnt.freq_ppm())
+        self.assertIs(tnt.axes[0].zero_filled(2), tnt.axes[0].with_npts(1024))
+
+        axis = tnt.axes[0].zero_filled(2)
+        spectrum = np.empty((1024, 6, 1, 1))
+        assert_array_equal(axis.freq_Hz, tnt.freq_Hz(spectrum))
+        assert_array_equal(axis.ppm_at(np.arange(1024)), tnt.freq_ppm(spectrum))
+
+        reverse_ppm = axis.freq_ppm[::-1]
+        ppm = np.concatenate([axis.freq_ppm, np.linspace(-600, 600, 101)])
+        (i_max, i_min) = axis.ppm_points(ppm, ppm)
+        assert_array_equal(i_max, 1024 - np.searchsorted(reverse_ppm, ppm, side='right'))
+        assert_array_equal(i_min, 1024 - np.searchsorted(reverse_ppm, ppm, side='left'))
+        for value in ppm[::10]:
+            self.assertEqual(tnt.ppm_points(value, value, spectrum),
+                             (i_max[ppm == value][0], i_min[ppm == value][0]))
+
+        # searchsorted puts NaN after all the other values
+        nan = float('nan')
+        self.assertEqual(axis.ppm_points(nan, nan),
+                         (1024 - np.searchsorted(reverse_ppm, nan, side='right'),
+                          1024 - np.searchsorted(reverse_ppm, nan, side='left')))
+        (i_max, i_min) = axis.ppm_points([nan, 10], [-10, nan])
+        assert_array_equal(i_max, 1024 - np.searchsorted(reverse_ppm, [nan, 10], side='right'))
+        assert_array_equal(i_min, 1024 - np.searchsorted(reverse_ppm, [-10, nan], side='left'))
+
+        times = tnt.axes[0].times
+        for side in ('left', 'right'):
+            assert_array_equal(tnt.axes[0].time_index(times, side),
+                               np.searchsorted(times, times, side))
+            self.assertEqual(tnt.axes[0].time_index(nan, side), 256)
+
+    def test_header_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            make_tnt_file(filename, actual_npts=(256, 6, 1, 1))
+            tnt = TNTfile(filename)
+        (i_max, i_min) = tnt.ppm_points(10, -10)
+
+        tnt.TMAG['ref_freq'] = tnt.TMAG['ob_freq'][0] * 10  # Shift by 10 ppm
+        self.assertEqual(tnt.axes[0].ref_freq, tnt.TMAG['ref_freq'])
+        assert_allclose(tnt.freq_ppm(), tnt.axes[0].freq_ppm)
+        assert_allclose(tnt.freq_ppm()[0], tnt.axes[0].ppm_at(0))
+        self.assertEqual(tnt.ppm_points(0, -20), (i_max, i_min))
+
+
+class TestFFTBackend(unittest.TestCase):
+
+    def test_plan_cache_bytes(self):
+        if 'pyfftw' not in fftbackend.available_backends():
+            self.skipTest("pyFFTW is not installed")
+        fftbackend.plan_cache_clear()
+        small = np.ones((64, 4), dtype=np.complex64)
+        large = np.ones((fftbackend.PLAN_CACHE_BYTES // 8, 1), dtype=np.complex64)
+        for a in (small, small, large):
+            assert_allclose(fftbackend.fft(a, axis=0, backend='pyfftw'),
+                            np.fft.fft(a, axis=0), atol=1e-3)
+        info = fftbackend.plan_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 2, 1))
+
+
+class TestProfiling(unittest.TestCase):
+
+    """Tests that the processing stages are timed"""
+
+    def test_profile(self):
+        records = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'synthetic.tnt')
+            make_tnt_file(filename, actual_npts=(256, 8, 1, 1),
+                          delay_tables={'de7:2': [1, 2, 3]})
+            with profiling.Profile(trace_memory=True, callback=records.append) as prof:
+                tnt = TNTfile(filename)
+                tnt.LBfft(10, 1, max_memory=256 * 2 * 16 * 3 * 4)
+                save_gnuplot_matrix(tnt, os.path.join(tmpdir, 'matrix.dat'),
+                                    blocks=tnt.iter_LBfft(10, 1))
+            TNTfile(filename)  # Not recorded
+
+        summary = prof.summary()
+        self.assertEqual(list(summary), ['header parse', 'delay scan',
+                                         'DATA mapping', 'DC offset', 'phasing',
+                                         'apodisation', 'FFT', 'export'])
+        self.assertEqual(summary['apodisation']['calls'], 3)
+        self.assertEqual(summary['apodisation']['bytes_read'], 2 * tnt.DATA.nbytes)
+        self.assertGreater(summary['delay scan']['bytes_read'], 0)
+        self.assertGreater(summary['FFT']['peak_alloc'], 0)
+        self.assertEqual(records, prof.records)
+        self.assertEqual(records[0]['file'], filename)
+        self.assertEqual(json.loads(prof.to_json())['summary']['FFT']['calls'], 3)
+
+
+class TestFindBackupFiles(unittest.TestCase):
+
+    """Tests that only the real backup files are found"""
+
+    def test_find(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = {'a/expt.tnt': 100, 'a/expt_1.tnt': 50, 'a/expt_2.tnt': 200,
+                     'a/expt_3.tnt': 50, 'a/other_1.tnt': 50,
+                     'a/expt.tnt_1.tnt': 10, 'a/b/c/x.tnt': 10, 'a/b/c/x_10.tnt': 10,
+                     'd/notes_1.txt': 10}
+            for name, size in files.items():
+                path = os.path.join(tmpdir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(bytes(size))
+                os.utime(path, (1000, 1000))
+            os.utime(os.path.join(tmpdir, 'a/expt_3.tnt'), (2000, 2000))
+
+            for threads in [1, 4]:
+                found = []
+                log = io.StringIO()
+                find_TNMR_backup_files(tmpdir, [lambda d, f: found.append(os.path.join(d, f))],
+                                       log, threads=threads)
+                expected = [os.path.join(tmpdir, name) for name in
+                            ['a/expt_1.tnt', 'a/expt.tnt_1.tnt', 'a/b/c/x_10.tnt']]
+                self.assertEqual(sorted(found), sorted(expected))
+                self.assertIn('expt_2.tnt is bigger than expt.tnt', log.getvalue())
+                self.assertIn('expt_3.tnt is newer than expt.tnt', log.getvalue())
+                self.assertIn('other_1.tnt does not have a matching base file',
+                              log.getvalue())
+
+    def test_walk_read_ahead(self):
+        class CountingExecutor(ThreadPoolExecutor):
+            def submit(self, *args):
+                future = super().submit(*args)
+                submitted.append(future)
+                self.max_pending = max(getattr(self, 'max_pending', 0),
+                                       sum(not f.done() for f in submitted))
+                return future
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i in range(30):
+                os.makedirs(os.path.join(tmpdir, 'd%d' % i, 'e', 'f'))
+            expected = [dirpath for dirpath, dirnames, filenames in os.walk(tmpdir)]
+            submitted = []
+            with CountingExecutor(max_workers=2) as executor:
+                walked = [dirpath for dirpath, files in _walk(tmpdir, executor, 3)]
+                self.assertLessEqual(executor.max_pending, 3)
+            self.assertEqual(walked, expected)
+
+            submitted = []
+            with CountingExecutor(max_workers=2) as executor:
+                walk = _walk(tmpdir, executor, 3)
+                next(walk)
+                walk.close()
+                self.assertLessEqual(len(submitted), 3)
+                self.assertTrue(all(f.done() for f in submitted))
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def path(fname):
+                return os.path.join(tmpdir, fname)
+            make_tnt_file(path('expt.tnt'), actual_npts=(128, 10, 1, 1))
+            make_tnt_file(path('expt_1.tnt'), actual_npts=(128, 4, 1, 1),
+                          actual_scans=8)
+            # The last spectrum of expt_1 is incomplete so it needn't match
+            backup = TNTfile(path('expt_1.tnt'), copy=True)
+            backup_DATA = np.array(backup.DATA)
+            backup_DATA[:, :3] = TNTfile(path('expt.tnt')).DATA[:, :3]
+            backup.write_inplace(backup_DATA, TMG2=False)
+            make_tnt_file(path('expt_2.tnt'), actual_npts=(128, 4, 1, 1), seed=1)
+            make_tnt_file(path('expt_3.tnt'), actual_npts=(64, 4, 1, 1))
+            make_tnt_file(path('expt.tnt_1.tnt'), actual_npts=(128, 10, 1, 1))
+            for fname in os.listdir(tmpdir):
+                if fname != 'expt.tnt':
+                    os.utime(path(fname), (1000, 1000))
+
+            found = []
+            log = io.StringIO()
+            find_TNMR_backup_files(tmpdir, [lambda d, f: found.append(f)], log,
+                                   threads=2, verify=True)
+            self.assertEqual(sorted(found), ['expt.tnt_1.tnt', 'expt_1.tnt'])
+            self.assertIn("expt_2.tnt does not match expt.tnt: its DATA differs "
+                          "after 0 bytes", log.getvalue())
+            self.assertIn("expt_3.tnt does not match expt.tnt: its dimensions",
+                          log.getvalue())
+
+    def test_batched_remove(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = ['-expt_%d.tnt' % i for i in range(20)]
+            for fname in fnames:
+                with open(os.path.join(tmpdir, fname), 'wb'):
+                    pass
+            log = io.StringIO()
+            remove = BatchedRemove(['rm', '--'], dry_run=True, max_arg_bytes=200,
+                                   log_std=log)
+            for fname in fnames:
+                remove(tmpdir, fname)
+            n_commands = remove.finish()
+            self.assertGreater(n_commands, 1)
+            self.assertEqual(log.getvalue(), "Would remove 20 files in 1 directories "
+                             "with 'rm --' (%d commands)\n" % n_commands)
+            self.assertEqual(len(os.listdir(tmpdir)), 20)
+
+            remove.dry_run = False
+            for fname in fnames:
+                remove(tmpdir, fname)
+            self.assertEqual(remove.finish(), n_commands)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+
 class TestRefFreq(unittest.TestCase):
 
     """Tests that the offset and reference frequencies are treated correctly"""
@@ -203,6 +743,90 @@ class TestFourierTransform(unittest.TestCase):
         tolerance = np.median(abs(freq_domain.DATA)) / 20
         assert_allclose(my_ft, freq_domain.DATA, atol=tolerance, rtol=1e-5)
 
+    def test_chunked(self):
+        nut2d = TNTfile("testdata/nut2d.tnt")
+
+        my_ft = nut2d.LBfft(10, 1)
+        npts_ft = my_ft.shape[0]
+        # Small enough to need one block per spectrum
+        chunked_ft = nut2d.LBfft(10, 1, max_memory=npts_ft * 16 * 3)
+        assert_allclose(chunked_ft, my_ft)
+
+        out = np.zeros_like(my_ft)
+        self.assertIs(nut2d.LBfft(10, 1, out=out), out)
+        assert_allclose(out, my_ft)
+
+    def test_single_precision(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+
+        my_ft = ref1.LBfft(10, 1)
+        single_ft = ref1.LBfft(10, 1, dtype=np.complex64)
+        self.assertEqual(single_ft.dtype, np.complex64)
+        assert_allclose(single_ft, my_ft, rtol=0, atol=1e-5 * abs(my_ft).max())
+
+    def test_fft_backends(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+
+        my_ft = ref1.LBfft(10, 1, fft_backend='numpy')
+        for backend in fftbackend.available_backends():
+            backend_ft = ref1.LBfft(10, 1, fft_backend=backend, workers=2)
+            assert_allclose(backend_ft, my_ft, rtol=1e-10, atol=1e-10)
+
+    def test_cached_vectors(self):
+        ref1 = TNTfile("testdata/LiCl_ref1.tnt")
+
+        my_ft = ref1.LBfft(10, 1, phase=0.5, ph1=0.1)
+        hits = cache_info()['lbweight'].hits
+        assert_allclose(ref1.LBfft(10, 1, phase=0.5, ph1=0.1), my_ft)
+        self.assertEqual(cache_info()['lbweight'].hits, hits + 1)
+
+        self.assertIs(ref1.freq_ppm(), ref1.freq_ppm())
+        self.assertFalse(ref1.freq_ppm().flags.writeable)
+
+
+class TestGnuplotMatrix(unittest.TestCase):
+
+    def test_blocks(self):
+        nut2d = TNTfile("testdata/nut2d.tnt")
+        nspec = nut2d.n_complete_spec()
+        my_ft = nut2d.LBfft(10, 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            array_file = os.path.join(tmpdir, 'array.dat')
+            blocks_file = os.path.join(tmpdir, 'blocks.dat')
+            save_gnuplot_matrix(nut2d, array_file, 50, -50,
+                                altDATA=my_ft[:, :nspec], block_size=3)
+            save_gnuplot_matrix(nut2d, blocks_file, 50, -50,
+                                blocks=nut2d.iter_LBfft(10, 1, max_memory=1))
+
+            imax, imin = nut2d.ppm_points(50, -50, my_ft)
+            gpt_matrix = np.fromfile(array_file, dtype='f4').reshape(
+                (imin - imax + 1, nspec + 1), order='F')
+            assert_allclose(gpt_matrix[1:, 1:],
+                            my_ft[imax:imin, :nspec, 0, 0].real, rtol=1e-6)
+            with open(array_file, 'rb') as f1, open(blocks_file, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class TestExport(unittest.TestCase):
+
+    def test_hdf5(self):
+        try:
+            import h5py
+        except ImportError:
+            self.skipTest("h5py is not installed")
+
+        nut2d = TNTfile("testdata/nut2d.tnt")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'nut2d.h5')
+            to_hdf5(nut2d, filename, lbfft={'LB': 10, 'zf': 1})
+            with h5py.File(filename, 'r') as h5file:
+                assert_allclose(h5file['DATA'][:], nut2d.DATA)
+                assert_allclose(h5file['spectrum'][:], nut2d.LBfft(10, 1),
+                                rtol=1e-5, atol=1e-5)
+                assert_allclose(h5file['DELAY/de7:2'][:], nut2d.DELAY['de7:2'])
+                self.assertEqual(h5file['TMAG'].attrs['scans'], nut2d.scans)
+
 
 class TestDelayTables(unittest.TestCase):
     
@@ -210,6 +834,87 @@ class TestDelayTables(unittest.TestCase):
         nut2d = TNTfile("testdata/nut2d.tnt")
         assert_allclose(nut2d.DELAY['de7:2'], np.arange(1.0, 9.0))
 
+    def test_small_chunks(self):
+        nut2d = TNTfile("testdata/nut2d.tnt")
+        with open("testdata/nut2d.tnt", 'rb') as f:
+            DELAY = scan_delay_tables(f, nut2d.tnt_sections['PSEQ']['offset'],
+                                      chunk_size=16)
+        self.assertEqual(DELAY.keys(), nut2d.DELAY.keys())
+        for name in DELAY:
+            assert_allclose(DELAY[name], nut2d.DELAY[name])
+
+    def test_convert_si(self):
+        assert_allclose(convert_si(['1', '2.5m', '3u', '1E', '1e3m', '.5k', '-2s']),
+                        [1, 2.5e-3, 3e-6, 1e18, 1, 500, -2])
+        assert_allclose(convert_si(['inf', '2n']), [np.inf, 2e-9])
+        self.assertEqual(convert_si([]).shape, (0,))
+        with self.assertRaisesRegex(ValueError, "entry 2 \\('3x'\\)"):
+            convert_si(['1', '2m', '3x'])
+        with self.assertRaisesRegex(ValueError, "entry 1 \\('m'\\)"):
+            convert_si(['1', 'm'])
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_load_many(self):
+        paths = ["testdata/LiCl_ref1.tnt", "testdata/does_not_exist.tnt",
+                 "testdata/LiCl_ref2.tnt"]
+        batch = load_many(paths, workers=2, lbfft={'LB': 10, 'zf': 1})
+
+        self.assertEqual(batch.paths, paths)
+        self.assertEqual(list(batch.errors.keys()), [paths[1]])
+        self.assertIsNone(batch.files[1])
+        ref2 = TNTfile(paths[2])
+        assert_allclose(batch.spectra[2], ref2.LBfft(10, 1))
+
+    def test_iter_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, 'expt%d.tnt' % i) for i in range(5)]
+            for i, path in enumerate(paths):
+                make_tnt_file(path, actual_npts=(64, i + 1, 1, 1))
+            paths.insert(2, os.path.join(tmpdir, 'does_not_exist.tnt'))
+
+            for prefetch in [0, 2]:
+                results = list(iter_files(paths, prefetch=prefetch, lazy=True))
+                self.assertEqual([result.path for result in results], paths)
+                self.assertIsInstance(results[2].error, FileNotFoundError)
+                self.assertEqual(results[5].tnt.DATA.shape, (64, 5, 1, 1))
+
+
+class TestIndex(unittest.TestCase):
+
+    def test_update_and_query(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with TNTIndex(os.path.join(tmpdir, 'index.sqlite')) as index:
+                paths = ["testdata/LiCl_ref1.tnt", "testdata/nut2d.tnt"]
+                self.assertEqual(index.update(paths), (2, 0, 0))
+                self.assertEqual(index.update(paths), (0, 2, 0))
+
+                ref1 = TNTfile(paths[0])
+                rows = index.query(start_after=ref1.start_time,
+                                   start_before=ref1.start_time)
+                self.assertEqual([row['path'] for row in rows],
+                                 [os.path.abspath(paths[0])])
+                self.assertAlmostEqual(rows[0]['ob_freq'], ref1.ob_freq[0])
+
+                rows = index.query(delay='de7:2')
+                self.assertEqual([row['path'] for row in rows],
+                                 [os.path.abspath(paths[1])])
+
+    def test_query_before_date(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fname, start_time in [('afternoon.tnt', datetime.datetime(2021, 3, 4, 15)),
+                                      ('next_day.tnt', datetime.datetime(2021, 3, 5))]:
+                make_tnt_file(os.path.join(tmpdir, fname), actual_npts=(16, 1, 1, 1),
+                              start_time=start_time)
+            database = os.path.join(tmpdir, 'index.sqlite')
+            index_main([database, 'update', tmpdir])
+            output = io.StringIO()
+            with redirect_stdout(output):
+                index_main([database, 'query', '--before', '2021-03-04'])
+            self.assertEqual(output.getvalue().splitlines(),
+                             [os.path.join(tmpdir, 'afternoon.tnt')])
+
 
 if __name__ == '__main__':
     unittest.main()